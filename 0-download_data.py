@@ -1,26 +1,22 @@
-from datetime import date, timedelta
-from time import strftime
-from pathlib import Path
-from os import system
+from datetime import date
+from os import listdir
+import argparse
+
+from mta_download import download_files, file_info, PREFIX, WORKERS
+from mta_lake import convert_to_lake, LAKEDIR
+from mta_resources import connect
 
 downloaddir = "downloads"
-prefix = "http://web.mta.info/developers/data/nyct/turnstile/turnstile_"
-suffix = ".txt"
 start_date = date(2019, 1, 7)  # start with 1st full week of 2019
 end_date = date.today()
-delta = end_date - start_date   # returns timedelta
-
-alldays = [start_date + timedelta(days=i) for i in range(delta.days + 1)]
-alldays = [day for day in alldays if day.weekday() == 5]
 
-for d in alldays:
-    infix = strftime("%y%m%d", d.timetuple())
-    url = "%s%s%s" % (prefix, infix, suffix)
-    src = "%s/%s%s" % (downloaddir, infix, suffix)
+parser = argparse.ArgumentParser(description="Download weekly MTA turnstile files")
+parser.add_argument("--prefix", default=PREFIX, help="URL prefix, e.g. a local HTTP server for testing")
+parser.add_argument("--workers", type=int, default=WORKERS, help="number of parallel downloads")
+args = parser.parse_args()
 
-    if Path(src).is_file():
-        continue
+download_files(downloaddir, start_date, end_date, prefix=args.prefix, workers=args.workers)
 
-    cmd = "curl %s > %s" % (url, src)
-    print(cmd)
-    system(cmd)
+# parse each new file once into the Parquet lake
+datafiles = sorted([downloaddir + "/" + f for f in listdir(downloaddir) if f[-4:] == ".txt"])
+convert_to_lake(connect(":memory:", "ingest"), file_info(datafiles, downloaddir), LAKEDIR)
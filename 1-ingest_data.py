@@ -1,10 +1,11 @@
 # load data from downloads into mta_raw table
 from time import strftime
-from os import path, listdir, getcwd, chdir
+from os import path, listdir, getcwd, chdir, getenv
 from pathlib import Path
-import subprocess
+import argparse
 
-import duckdb
+from mta_ingest import ingest, verify
+from mta_resources import connect, Stages
 
 
 def run_sql(query, verbose=False):
@@ -23,64 +24,35 @@ def log(s):
 
 CURRENTFILE = path.basename(__file__)
 BASEDIR = Path(__file__).parent.resolve()
-DBFILE = "mta.db"
+# DBFILE can name a new version of the database to publish afterwards, see mta_publish.py
+DBFILE = getenv("DBFILE", "mta.db")
 DATADIR = "downloads"
 chdir(BASEDIR)
 
+parser = argparse.ArgumentParser(description="Load new or changed files from downloads into mta_raw")
+parser.add_argument("--full-refresh", action="store_true", help="drop mta_raw and reload every file")
+parser.add_argument("--threads", type=int,
+                    help="DuckDB threads for the load (default: DUCKDB_INGEST_THREADS, DUCKDB_THREADS "
+                         "or number of cores, see mta_resources.py)")
+args = parser.parse_args()
+
 log("Starting data load in %s" % getcwd())
 log("Loading into %s/%s" % (BASEDIR, DBFILE))
-log("Creating mta_raw table")
-
-con = duckdb.connect('mta.db')
-query = """
-create or replace table mta_raw(
-    "C/A" VARCHAR,
-    UNIT VARCHAR,
-    SCP VARCHAR,
-    STATION VARCHAR,
-    LINENAME VARCHAR,
-    DIVISION VARCHAR,
-    DATE DATE,
-    TIME TIME,
-    "DESC" VARCHAR,
-    ENTRY_COUNTER INTEGER,
-    EXIT_COUNTER INTEGER);
-"""
-run_sql(query)
+con = connect(DBFILE, "ingest")
+stages = Stages.for_connection(con, DBFILE, log)
 
 datafiles = sorted([DATADIR + "/" + f for f in listdir(DATADIR) if f[-4:] == ".txt"])
 
 log("Found %d files in %s/%s" % (len(datafiles), getcwd(), DATADIR))
-
-query = """
-insert into mta_raw SELECT * FROM read_csv('%s', \
-                                                 delim=',', \
-                                                 header=True, \
-                                                 columns={'C/A': 'VARCHAR', \
-                                                          'UNIT': 'VARCHAR', \
-                                                          'SCP': 'VARCHAR', \
-                                                          'STATION': 'VARCHAR', \
-                                                          'LINENAME': 'VARCHAR', \
-                                                          'DIVISION': 'VARCHAR', \
-                                                          'DATE': 'DATE', \
-                                                          'TIME': 'TIME',\
-                                                          'DESC': 'VARCHAR',\
-                                                          'ENTRIES': 'INTEGER',\
-                                                          'EXITS': 'INTEGER',},\
-                                                      dateformat='%%m/%%d/%%Y');
-"""
+stages.start("ingest")
 log("Ingesting")
 
-for f in datafiles:
-    log("Loading %s" % f)
-    run_sql(query % f)
+ingest(con, datafiles, DATADIR, full_refresh=args.full_refresh, threads=args.threads)
 
+stages.start("verify")
 log("Verifying")
-result = subprocess.run(['wc', '-l', ] + datafiles, stdout=subprocess.PIPE)
-lastresult = result.stdout.splitlines()[-1]
-# total lines - number of header rows
-expected = int(lastresult.split()[0]) - len(datafiles)
-log("Expected %d rows from 'wc'" % expected)
-result = run_sql('select count(*) from mta_raw')
-log("Loaded   %d rows into mta_raw" % result[0][0])
+mismatches = verify(con)
+stages.finish()
+if mismatches:
+    log("%d files did not load completely" % len(mismatches))
 log("Ended data load from %s/%s" % (getcwd(), DATADIR))
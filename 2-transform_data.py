@@ -1,9 +1,12 @@
 # create mta_staging and mta_clean from mta_raw
 
 from time import strftime
-from os import path, getcwd, chdir
+from os import path, getcwd, chdir, getenv
 from pathlib import Path
-import duckdb
+import argparse
+
+from mta_outliers import update_moments, compute_cutoffs, create_clean
+from mta_resources import connect, Stages
 
 
 def run_sql(query, verbose=False):
@@ -23,40 +26,89 @@ def log(s):
 CURRENTFILE = path.basename(__file__)
 BASEDIR = Path(__file__).parent.resolve()
 chdir(BASEDIR)
-HARD_CUTOFF = 7200
-
-log("Starting data load in %s" % getcwd())
-log("Creating mta_raw table")
+# DBFILE can name a new version of the database to publish afterwards, see mta_publish.py
+DBFILE = getenv("DBFILE", "mta.db")
 
-con = duckdb.connect('mta.db')
+parser = argparse.ArgumentParser(description="Create mta_staging and mta_clean from mta_raw")
+parser.add_argument("--full-refresh", action="store_true",
+                    help="drop mta_staging, turnstile_state and mta_diff and stage and difference every row again")
+args = parser.parse_args()
 
-log("Creating mta_staging and deduplicating")
+log("Starting data load in %s" % getcwd())
+log("Transforming mta_raw in %s/%s" % (BASEDIR, DBFILE))
+
+con = connect(DBFILE, "transform")
+stages = Stages.for_connection(con, DBFILE, log)
+
+# mta_staging holds one row per reading, keyed on (TURNSTILE_ID, DATE_TIME), READINGS is the number of raw rows
+# it stands for. Of conflicting raw rows for a key the highest entry counter wins, then the highest exit counter,
+# within a run and across runs: a staged reading is replaced by a conflicting one staged later only if it is higher.
+# Each run stages only the mta_raw days new files touch, from the first day of any file not in transformed_files,
+# the ingest_ledger files as of the last complete run: new or changed files, or a late download of an earlier week.
+staging_columns = [row[0].upper() for row in
+                   run_sql("select column_name from information_schema.columns where table_name = 'mta_staging'")]
+if staging_columns and "READINGS" not in staging_columns:
+    log("mta_staging has no key, staging every row again")
+    run_sql("drop table mta_staging; drop table if exists transformed_files;")
+if args.full_refresh:
+    log("Full refresh, dropping mta_staging")
+    run_sql("drop table if exists mta_staging; drop table if exists transformed_files;")
+log("Creating mta_staging table if it doesn't exist")
+query = """
+create table if not exists mta_staging(
+    TURNSTILE_ID INTEGER,
+    STATION_ID INTEGER,
+    DATE_TIME TIMESTAMP,
+    ENTRY_COUNTER INTEGER,
+    EXIT_COUNTER INTEGER,
+    READINGS INTEGER,
+    PRIMARY KEY (TURNSTILE_ID, DATE_TIME));
+"""
+run_sql(query)
+# a database from before transformed_files was kept starts with the files that end by the last staged reading
 query = """
-    create or replace table mta_staging as
-    select distinct
-        CONCAT("C/A" , ' ' , UNIT , ' ' , SCP) TURNSTILE,
-        CONCAT(STATION, '-', LINENAME) STATION,
-        DIVISION,
-        "DATE",
-        make_timestamp(date_part('year', DATE),
-            date_part('month', DATE),
-            date_part('day', DATE),
-            date_part('hour', TIME),
-            date_part('minute', TIME),
-            date_part('second', TIME)) DATE_TIME,
-        ENTRY_COUNTER,
-        EXIT_COUNTER
-    from mta_raw
-    where "DESC" <> 'RECOVR AUD'
+create table if not exists transformed_files as
+select FILENAME, SHA256 from ingest_ledger
+where MAX_DATE <= (select max(DATE_TIME)::date from mta_staging);
 """
 run_sql(query)
+query = """
+select min(MIN_DATE) from ingest_ledger
+where (select max(DATE_TIME) from mta_staging) is null
+or not exists (select 1 from transformed_files
+               where transformed_files.FILENAME = ingest_ledger.FILENAME
+               and transformed_files.SHA256 = ingest_ledger.SHA256)
+"""
+reprocess_from = run_sql(query)[0][0]
+
+stages.start("stage")
+log("Creating new_readings from mta_raw, days from %s" % (reprocess_from or "none, no new files"))
+query = """
+create or replace temp table new_readings as
+select
+    CONCAT("C/A" , ' ' , UNIT , ' ' , SCP) TURNSTILE,
+    CONCAT(STATION, '-', LINENAME) STATION,
+    DIVISION,
+    make_timestamp(date_part('year', DATE),
+        date_part('month', DATE),
+        date_part('day', DATE),
+        date_part('hour', TIME),
+        date_part('minute', TIME),
+        date_part('second', TIME)) DATE_TIME,
+    ENTRY_COUNTER,
+    EXIT_COUNTER
+from mta_raw
+where "DESC" <> 'RECOVR AUD'
+and DATE >= $1
+"""
+con.execute(query, [reprocess_from])
 
-result = run_sql('select count(*) from mta_staging')
-log("Loaded   %d rows into mta_staging" % result[0][0])
+result = run_sql('select count(*) from new_readings')
+log("Loaded   %d rows into new_readings" % result[0][0])
 
 log("Make combined station name from STATION, DIVISION")
 query = """
-update mta_staging
+update new_readings
 set station = concat(station, '-', division)
 where division not in ('RIT', 'BMT', 'IRT', 'IND');
 """
@@ -92,149 +144,211 @@ for k, v in fixes.items():
     run_sql(f"insert into station_name_map values ('{k}', '{v}');")
 
 query = """
-update mta_staging
+update new_readings
 set station = (
     select station_dest from station_name_map
-    where station_name_map.station_src = mta_staging.station
+    where station_name_map.station_src = new_readings.station
 )
 where station in (select station_src from station_name_map);
 """
 run_sql(query)
 
-log("Drop unused columns")
+# station_dim and turnstile_dim give each station and each turnstile at a station a dense integer id.
+# New names are appended, so ids stay the same across runs. mta_diff, turnstile_state and mta_clean
+# window, group and join on the ids instead of the names, the names are joined back at the end.
+stages.start("ids")
+log("Assign ids to new stations and turnstiles")
 query = """
-ALTER TABLE mta_staging DROP DIVISION;
+create table if not exists station_dim(
+    STATION_ID INTEGER PRIMARY KEY,
+    STATION VARCHAR UNIQUE);
+create table if not exists turnstile_dim(
+    TURNSTILE_ID INTEGER PRIMARY KEY,
+    TURNSTILE VARCHAR,
+    STATION_ID INTEGER,
+    UNIQUE (STATION_ID, TURNSTILE));
+insert into station_dim
+select (select coalesce(max(STATION_ID), 0) from station_dim) + row_number() over (order by STATION), STATION
+from (select distinct STATION from new_readings) stations
+where not exists (select 1 from station_dim where station_dim.STATION = stations.STATION);
+insert into turnstile_dim
+select (select coalesce(max(TURNSTILE_ID), 0) from turnstile_dim) + row_number() over (order by STATION_ID, TURNSTILE),
+    TURNSTILE, STATION_ID
+from (select distinct TURNSTILE, STATION_ID from new_readings join station_dim using (STATION)) turnstiles
+where not exists (select 1 from turnstile_dim
+                  where turnstile_dim.STATION_ID = turnstiles.STATION_ID
+                  and turnstile_dim.TURNSTILE = turnstiles.TURNSTILE);
 """
 run_sql(query)
+result = run_sql("select (select count(*) from station_dim), (select count(*) from turnstile_dim)")
+log("%d stations in station_dim, %d turnstiles in turnstile_dim" % result[0])
 
-log("Create mta_clean and diff by turnstile")
+stages.start("deduplicate")
+log("Deduplicate new_readings on (TURNSTILE_ID, DATE_TIME)")
 query = """
-CREATE OR REPLACE TABLE mta_clean AS
-SELECT DATE, DATE_TIME, STATION, TURNSTILE,
-ENTRY_COUNTER,
-ENTRY_COUNTER - lag(ENTRY_COUNTER) OVER (PARTITION BY STATION, TURNSTILE ORDER BY DATE_TIME) AS ENTRIES,
-2000 ENTRIES_CUTOFF,
-EXIT_COUNTER,
-EXIT_COUNTER - lag(EXIT_COUNTER) OVER (PARTITION BY STATION, TURNSTILE ORDER BY DATE_TIME) AS EXITS,
-2000 EXITS_CUTOFF,
-0 DELETE_MARKER
-FROM mta_staging;
+create or replace temp table new_staging as
+select TURNSTILE_ID, STATION_ID, DATE_TIME, READING.ENTRY_COUNTER, READING.EXIT_COUNTER, READINGS
+from (
+    select turnstile_dim.TURNSTILE_ID, turnstile_dim.STATION_ID, DATE_TIME,
+        -- structs compare field by field, max picks the winning reading
+        max({'entry_counter': ENTRY_COUNTER, 'exit_counter': EXIT_COUNTER}) READING,
+        count(*) READINGS
+    from new_readings
+    join station_dim using (STATION)
+    join turnstile_dim on turnstile_dim.STATION_ID = station_dim.STATION_ID
+        and turnstile_dim.TURNSTILE = new_readings.TURNSTILE
+    group by turnstile_dim.TURNSTILE_ID, turnstile_dim.STATION_ID, DATE_TIME
+);
+drop table new_readings;
 """
 run_sql(query)
-
-result = run_sql('select count(*) from mta_clean')
-log("Loaded   %d rows into mta_clean" % result[0][0])
-
-# run_sql("drop table mta_staging;")
-
-query = """
-ALTER TABLE mta_clean drop column ENTRY_COUNTER;
-ALTER TABLE mta_clean drop column EXIT_COUNTER;
-"""
-run_sql(query)
-
-log("Delete NULLs (start of window with no diff)")
-run_sql("delete from mta_clean where entries is null and exits is null;")
-
-log("Delete negatives where turnstile counter got reset during maintenance")
-run_sql("delete from mta_clean where ENTRIES < 0; delete from mta_clean where EXITS < 0;")
-
-log("Delete entries or exits greater than hard limit of %d" % HARD_CUTOFF)
-run_sql("delete from mta_clean where ENTRIES>%d; delete from mta_clean where EXITS>%d;" % (HARD_CUTOFF, HARD_CUTOFF))
-
-result = run_sql('select count(*) from mta_clean')
-log("Left     %d rows into mta_clean" % result[0][0])
-
-log("Compute average, sd, observation count by turnstile")
+# a reading conflicting with a staged one drops the lower of the two, as they are counted in READINGS
 query = """
-create or replace table entry_avg as
-select station, TURNSTILE, avg(entries) MEAN, stddev(entries) SD, count(*) N,
-from mta_clean
-where entries > 0
-group by station, TURNSTILE;
+with readings as (
+    select new_staging.READINGS, mta_staging.TURNSTILE_ID is null NEW_KEY,
+        {'entry_counter': new_staging.ENTRY_COUNTER, 'exit_counter': new_staging.EXIT_COUNTER} NEW_READING,
+        {'entry_counter': mta_staging.ENTRY_COUNTER, 'exit_counter': mta_staging.EXIT_COUNTER} STAGED_READING
+    from new_staging
+    left join mta_staging on mta_staging.TURNSTILE_ID = new_staging.TURNSTILE_ID
+        and mta_staging.DATE_TIME = new_staging.DATE_TIME
+)
+select
+    count(*),
+    coalesce(sum(READINGS), 0) - count(*)
+        + count(*) filter (where not NEW_KEY and NEW_READING is distinct from STAGED_READING),
+    count(*) filter (where READINGS > 1 or (not NEW_KEY and NEW_READING is distinct from STAGED_READING)),
+    count(*) filter (where not NEW_KEY and NEW_READING > STAGED_READING),
+    count(*) filter (where NEW_KEY)
+from readings
 """
-run_sql(query)
+readings, dropped, duplicated, replaced, inserted = run_sql(query)[0]
+log("Dropped  %d duplicate rows from %d of %d readings, replacing %d staged readings"
+    % (dropped, duplicated, readings, replaced))
 query = """
-create or replace table exit_avg as
-select station, TURNSTILE, avg(exits) MEAN, stddev(exits) SD, count(*) N,
-from mta_clean
-where exits > 0
-group by station, TURNSTILE;
+insert into mta_staging as staged select * from new_staging
+on conflict (TURNSTILE_ID, DATE_TIME) do update
+set ENTRY_COUNTER = excluded.ENTRY_COUNTER, EXIT_COUNTER = excluded.EXIT_COUNTER, READINGS = excluded.READINGS
+where {'entry_counter': excluded.ENTRY_COUNTER, 'exit_counter': excluded.EXIT_COUNTER}
+    > {'entry_counter': staged.ENTRY_COUNTER, 'exit_counter': staged.EXIT_COUNTER}
 """
 run_sql(query)
+log("Inserted %d readings into mta_staging, the rest were already staged" % inserted)
+run_sql("drop table new_staging")
+
+# mta_diff holds the first differences of each turnstile's counters, turnstile_state its last reading.
+# Each run differences only each turnstile's mta_staging rows newer than its turnstile_state reading, against
+# that reading, instead of windowing the whole history. Changed station fixes need --full-refresh.
+diff_columns = [row[0].upper() for row in
+                run_sql("select column_name from information_schema.columns where table_name = 'mta_diff'")]
+if diff_columns and "TURNSTILE_ID" not in diff_columns and not args.full_refresh:
+    log("mta_diff is keyed on station and turnstile names, not ids, differencing every row again")
+    args.full_refresh = True
+# readings just staged at or before their turnstile's last differenced one, e.g. from a late download of an
+# earlier week or a changed file, change differences already taken
+state_columns = [row[0].upper() for row in
+                 run_sql("select column_name from information_schema.columns where table_name = 'turnstile_state'")]
+if state_columns and not args.full_refresh:
+    query = """
+    select count(*), min(mta_staging.DATE_TIME) from mta_staging
+    join turnstile_state on turnstile_state.TURNSTILE_ID = mta_staging.TURNSTILE_ID
+    where mta_staging.DATE_TIME >= $1 and mta_staging.DATE_TIME <= turnstile_state.DATE_TIME
+    """
+    con.execute(query, [reprocess_from])
+    backdated, earliest = con.fetchall()[0]
+    if backdated:
+        log("%d staged readings from %s are at or before their turnstile's last differenced reading, "
+            "differencing every row again" % (backdated, earliest))
+        args.full_refresh = True
+if args.full_refresh:
+    log("Full refresh, dropping turnstile_state, mta_diff and turnstile_moments")
+    run_sql("drop table if exists turnstile_state; drop table if exists mta_diff; "
+            "drop table if exists turnstile_moments;")
 
-log("Compute a cutoff by turnstile based on max(2000, mean+3SD where n>20)")
-query = """
-alter table entry_avg add column ENTRIES_CUTOFF DOUBLE;
-update entry_avg set ENTRIES_CUTOFF = MEAN + 3 * SD;
-update entry_avg set ENTRIES_CUTOFF = 2000 where N <= 20;
-update entry_avg set ENTRIES_CUTOFF = 2000 where isnan(ENTRIES_CUTOFF);
-update entry_avg set ENTRIES_CUTOFF = 2000 where ENTRIES_CUTOFF < 2000;
-"""
-run_sql(query)
 query = """
-alter table exit_avg add column EXITS_CUTOFF DOUBLE;
-update exit_avg set EXITS_CUTOFF = MEAN + 3 * SD;
-update exit_avg set EXITS_CUTOFF = 2000 where N <= 20;
-update exit_avg set EXITS_CUTOFF = 2000 where isnan(EXITS_CUTOFF);
-update exit_avg set EXITS_CUTOFF = 2000 where EXITS_CUTOFF < 2000;
+create table if not exists turnstile_state(
+    TURNSTILE_ID INTEGER PRIMARY KEY,
+    STATION_ID INTEGER,
+    DATE_TIME TIMESTAMP,
+    ENTRY_COUNTER INTEGER,
+    EXIT_COUNTER INTEGER);
+create table if not exists mta_diff(
+    DATE DATE,
+    DATE_TIME TIMESTAMP,
+    STATION_ID INTEGER,
+    TURNSTILE_ID INTEGER,
+    ENTRIES INTEGER,
+    EXITS INTEGER);
+create table if not exists turnstile_moments(
+    TURNSTILE_ID INTEGER,
+    STATION_ID INTEGER,
+    DIRECTION VARCHAR,
+    N BIGINT,
+    MEAN DOUBLE,
+    M2 DOUBLE,
+    DATE_TIME TIMESTAMP,
+    PRIMARY KEY (TURNSTILE_ID, DIRECTION));
 """
 run_sql(query)
 
-log("Update entries_cutoff in each row in mta_clean table")
-query = """
-update mta_clean
-set ENTRIES_CUTOFF = (
-select ENTRIES_CUTOFF from entry_avg
-    where
-    entry_avg.station = mta_clean.station and
-    entry_avg.turnstile = mta_clean.turnstile
-)
-where exists (
-    select 1 from entry_avg
-    where
-    entry_avg.station = mta_clean.station and
-    entry_avg.turnstile = mta_clean.turnstile
-)
+stages.start("diff")
+log("Diff by turnstile, rows after each turnstile's state")
+# each turnstile's readings after its turnstile_state reading, every reading of a turnstile with none
+new_readings = """
+select mta_staging.TURNSTILE_ID, mta_staging.STATION_ID, mta_staging.DATE_TIME,
+    mta_staging.ENTRY_COUNTER, mta_staging.EXIT_COUNTER
+from mta_staging
+left join turnstile_state on turnstile_state.TURNSTILE_ID = mta_staging.TURNSTILE_ID
+where turnstile_state.DATE_TIME is null or mta_staging.DATE_TIME > turnstile_state.DATE_TIME
 """
-run_sql(query)
 query = """
-update mta_clean
-set EXITS_CUTOFF = (
-select EXITS_CUTOFF from exit_avg
-    where
-    exit_avg.station = mta_clean.station and
-    exit_avg.turnstile = mta_clean.turnstile
+insert into mta_diff
+select * exclude (CARRIED) from (
+    SELECT DATE_TIME::DATE DATE, DATE_TIME, STATION_ID, TURNSTILE_ID,
+    ENTRY_COUNTER - lag(ENTRY_COUNTER) OVER (PARTITION BY TURNSTILE_ID ORDER BY DATE_TIME) AS ENTRIES,
+    EXIT_COUNTER - lag(EXIT_COUNTER) OVER (PARTITION BY TURNSTILE_ID ORDER BY DATE_TIME) AS EXITS,
+    CARRIED
+    FROM (
+        select TURNSTILE_ID, STATION_ID, DATE_TIME, ENTRY_COUNTER, EXIT_COUNTER, true CARRIED from turnstile_state
+        union all
+        select *, false CARRIED from (%s)
+    )
 )
-where exists (
-    select 1 from exit_avg
-    where
-    exit_avg.station = mta_clean.station and
-    exit_avg.turnstile = mta_clean.turnstile
-)
-"""
-
-log("Delete based on entries or exits > cutoff")
-run_sql("delete from mta_clean where entries > entries_cutoff;")
-run_sql("delete from mta_clean where exits > exits_cutoff;")
-
-result = run_sql('select count(*) from mta_clean')
-log("Left     %d rows into mta_clean" % result[0][0])
-
-log("Delete where both entries and exits are 0")
-query = "delete from mta_clean where entries = 0 and exits = 0;"
-run_sql(query)
-
-result = run_sql('select count(*) from mta_clean')
-log("Left     %d rows into mta_clean" % result[0][0])
-
-log("Finishing")
-
-query = """
-ALTER TABLE mta_clean drop column ENTRIES_CUTOFF;
-ALTER TABLE mta_clean drop column EXITS_CUTOFF;
-ALTER TABLE mta_clean drop column DELETE_MARKER;
-"""
-run_sql(query)
-
+-- new rows only, less NULLs (start of window with no diff)
+where not CARRIED and (ENTRIES is not null or EXITS is not null)
+""" % new_readings
+state_query = """
+insert or replace into turnstile_state
+select TURNSTILE_ID, STATION_ID, max(DATE_TIME), arg_max(ENTRY_COUNTER, DATE_TIME), arg_max(EXIT_COUNTER, DATE_TIME)
+from (%s)
+group by TURNSTILE_ID, STATION_ID
+""" % new_readings
+# turnstile_moments holds each turnstile's running moments, the outlier cutoffs come from them.
+# The new mta_diff rows are merged into it, see mta_outliers.py
+con.begin()
+try:
+    con.execute(query)
+    log("Diffed   %d new rows into mta_diff" % con.fetchall()[0][0])
+    con.execute(state_query)
+    log("Updated  %d turnstiles in turnstile_state" % con.fetchall()[0][0])
+    log("Updated  %d turnstile moments in turnstile_moments" % update_moments(con))
+    con.commit()
+except Exception:
+    con.rollback()
+    raise
+
+# mta_clean is mta_diff less outliers, built in one pass, see mta_outliers.py for the rules
+stages.start("cutoffs")
+log("Compute average, sd, observation count and cutoff by turnstile from turnstile_moments")
+compute_cutoffs(con)
+
+stages.start("mta_clean")
+log("Create mta_clean from mta_diff, dropping outliers and joining station and turnstile names")
+rows = create_clean(con)
+result = run_sql("select count(*) from mta_diff")
+log("Left     %d of %d mta_diff rows in mta_clean, dropped %d outliers" % (rows, result[0][0], result[0][0] - rows))
+
+# the files this run transformed, the next run stages from the first day of any other
+run_sql("create or replace table transformed_files as select FILENAME, SHA256 from ingest_ledger")
+
+stages.finish()
 log("Finished data load")
@@ -8,7 +8,16 @@ export FLASK_APP="superset"
 # export MAPBOX_API_KEY= see https://docs.mapbox.com/help/getting-started/access-tokens/
 # export ENABLE_TEMPLATE_PROCESSING=True or set in superset's config.py
 
+# build a new version of the database and publish it if the tests pass, see build.sh
+cd $BASEDIR
+# DuckDB memory_limit, threads, temp_directory and preserve_insertion_order per workload, see duckdb.env
+eval "$(python mta_resources.py env)"
+LIVEDB=$DBFILE
+export DBFILE=$(python mta_publish.py name $LIVEDB)
+python mta_publish.py prepare $LIVEDB $DBFILE
+
 cd $BASEDIR/dbt_mta
 dbt seed
-dbt run
-dbt test
+# logs each dbt command's time, peak RSS and peak spill
+RUN="python $BASEDIR/mta_resources.py run dbt $BASEDIR/$DBFILE --"
+$RUN dbt run && $RUN dbt test && python $BASEDIR/mta_publish.py publish $BASEDIR/$LIVEDB $DBFILE
@@ -15,15 +15,27 @@ conda activate dbt
 # export MAPBOX_API_KEY= see https://docs.mapbox.com/help/getting-started/access-tokens/
 # export ENABLE_TEMPLATE_PROCESSING=True doesn't work, edit in superset's config.py
 
-# stop anything that is using mta.db (superset or plotlydash)
-# put appropriate commands in wrapper.c and setuid on executable to run with root privileges
-# $BASEDIR/suid_stop_plotlydash
+# build into a new version of the database while the dashboard keeps reading mta.db.
+# mta.db is a symlink to the live version, it's swapped atomically once dbt test passes
+# and the dashboard switches over between requests, so plotlydash no longer needs stopping.
+# superset holds its connection, restart it after publishing, e.g. with a setuid wrapper (suid_wrapper.c)
+cd $BASEDIR
+# DuckDB memory_limit, threads, temp_directory and preserve_insertion_order per workload, see duckdb.env
+eval "$(python mta_resources.py env)"
+LIVEDB=$DBFILE
+export DBFILE=$(python mta_publish.py name $LIVEDB)
+python mta_publish.py prepare $LIVEDB $DBFILE
 
 cd $BASEDIR/dbt_mta
 dbt seed
-dbt run
-dbt test
-
-# $BASEDIR/suid_start_plotlydash
+# mta_staging, mta_diff and mta_clean are incremental, only the new weeks are processed
+# use dbt run --full-refresh after editing a seed, or when mta_diff asks for it (a late download of an earlier week)
+# profiles.yml reads BASEDIR and DBFILE, so dbt builds the new version
+# logs each dbt command's time, peak RSS and peak spill
+RUN="python $BASEDIR/mta_resources.py run dbt $BASEDIR/$DBFILE --"
+# row groups the standard dashboard queries scan and skip, mta_clean and the rollups are sorted by (date, station),
+# only once a new version is published, LIVEDB is otherwise the previous one
+$RUN dbt run && $RUN dbt test && python $BASEDIR/mta_publish.py publish $BASEDIR/$LIVEDB $DBFILE && \
+    python $BASEDIR/mta_pruning.py $BASEDIR/$LIVEDB
 
 date
@@ -1,29 +1,39 @@
 import os
-from time import strftime
+from time import strftime, perf_counter
 from datetime import date, datetime
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import hashlib
+import json
+import threading
 from six import string_types
-from copy import deepcopy
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 # db stuff
+import duckdb
 import sqlalchemy
 from jinjasql import JinjaSql
 
 # plotly
 import plotly
 import plotly.express as px
-from dash import Dash, html, dcc, dash_table
+import plotly.graph_objects as go
+from dash import Dash, Patch, html, dcc, dash_table
 import dash_bootstrap_components as dbc
 from dash.dash_table import FormatTemplate
 from dash.dash_table.Format import Format, Scheme
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 
 from dotenv import load_dotenv
 
 load_dotenv()
+# DuckDB settings shared with the build, see mta_resources.py, variables already set take precedence
+load_dotenv(os.getenv('DUCKDB_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'duckdb.env')))
 mapbox_token = os.getenv('MAPBOX_TOKEN')
 
 DATADIR = os.getenv('DATADIR')
@@ -33,14 +43,30 @@ if not DATADIR:
 DATAFILE = os.getenv('DATAFILE')
 DATAPATH = "%s/%s" % (DATADIR, DATAFILE)
 
-connection_string = 'duckdb:////%s' % DATAPATH
-# print(connection_string)
-con = sqlalchemy.create_engine(connection_string, connect_args={'read_only': True})
+# each request checks out its own connection and runs only CTE queries (no temp tables),
+# so requests are isolated and the app can run threaded and under several gunicorn workers
+POOL_SIZE = int(os.getenv('POOL_SIZE', 8))
 
 # print sql queries
 verbosity = 0
 debug = False
 
+# query results are cached by filters, up to CACHE_ENTRIES results and CACHE_MB of DataFrames
+CACHE_ENTRIES = int(os.getenv('CACHE_ENTRIES', 256))
+CACHE_MB = int(os.getenv('CACHE_MB', 256))
+
+# DuckDB memory_limit, threads, temp_directory and preserve_insertion_order for the dashboard's connections,
+# from DUCKDB_DASHBOARD_<SETTING>, else DUCKDB_<SETTING>, else DuckDB's default
+DUCKDB_SETTINGS = {name: os.getenv('DUCKDB_DASHBOARD_' + name.upper()) or os.getenv('DUCKDB_' + name.upper())
+                   for name in ['memory_limit', 'threads', 'temp_directory', 'preserve_insertion_order']}
+DUCKDB_SETTINGS = {name: value for name, value in DUCKDB_SETTINGS.items() if value}
+
+# 'separate' runs one query per panel result, so each panel paints as soon as its own query returns,
+# 'fused' runs one statement sharing one scan for all panels, which all wait for it
+QUERY_MODE = os.getenv('QUERY_MODE', 'separate')
+# a panel's separate queries run concurrently on up to QUERY_THREADS DuckDB cursors (see cached_results)
+QUERY_THREADS = int(os.getenv('QUERY_THREADS', 4))
+
 ############################################################
 # queries to return dataframes for dashboard
 ############################################################
@@ -63,27 +89,127 @@ def quote_sql_string(value):
     return value
 
 
-def get_sql_from_template(con, query, bind_params=None, verbose=False):
+# result columns holding station names, returned as categoricals
+STATION_COLUMNS = ['station', 'pretty_name']
+INT32 = np.iinfo(np.int32)
+
+
+def downcast(df):
+    """int32 for integer columns that fit, categorical station names"""
+    for column in df.columns:
+        if pd.api.types.is_integer_dtype(df[column]) and df[column].dtype != np.int32:
+            if len(df) == 0 or (df[column].min() >= INT32.min and df[column].max() <= INT32.max):
+                df[column] = df[column].astype(np.int32)
+        elif column in STATION_COLUMNS and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
+
+
+def arrow_df(table):
+    """pyarrow Table -> downcast DataFrame, HUGEINT sums arrive as decimals and become float64"""
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    return downcast(table.to_pandas())
+
+
+class Slot:
+    """stands in for a bind param while a template renders, records which param (and list item) it was"""
+
+    def __init__(self, key, index=None):
+        self.key = key
+        self.index = index
+
+    def value(self, bind_params):
+        value = bind_params[self.key]
+        return value if self.index is None else value[self.index]
+
+
+def params_shape(bind_params):
+    """the params that are set and the length of each list, this decides the SQL a template renders"""
+    return tuple(sorted((key, len(value) if isinstance(value, (list, tuple)) else None)
+                        for key, value in bind_params.items() if value))
+
+
+class TemplateRegistry:
     """
-    Run Jinja template query against con, substituting bind_params
+    Query templates compiled once, and the SQL each renders cached per params_shape.
+    A template is rendered once per shape with Slots for the param values, later calls with
+    the same shape only look up the values in the order the Slots were bound.
+    Templates must only test params for truthiness ({% if sta %}) and bind them ({{ }} or inclause).
+    """
+
+    def __init__(self, param_style='qmark', max_rendered=4096):
+        self.jinja = JinjaSql(param_style=param_style)
+        self.max_rendered = max_rendered
+        self.templates = {}
+        self.rendered = {}
+        self.lock = threading.Lock()
+
+    def compile(self, source):
+        template = self.templates.get(source)
+        if template is None:
+            template = self.jinja.env.from_string(source)
+            with self.lock:
+                self.templates[source] = template
+        return template
+
+    def prepare_query(self, source, bind_params):
+        """(query string, list of values) for source with bind_params, same as JinjaSql.prepare_query"""
+        key = (source, params_shape(bind_params))
+        rendered = self.rendered.get(key)
+        if rendered is None:
+            slots = {k: [Slot(k, i) for i in range(len(v))] if isinstance(v, (list, tuple)) else Slot(k)
+                     for k, v in bind_params.items() if v}
+            rendered = self.jinja.prepare_query(self.compile(source), dict(bind_params, **slots))
+            with self.lock:
+                # shapes are few in practice, start over rather than grow without bound
+                if len(self.rendered) >= self.max_rendered:
+                    self.rendered.clear()
+                self.rendered[key] = rendered
+        query_str, slots = rendered
+        return query_str, [slot.value(bind_params) for slot in slots]
+
+
+templates = TemplateRegistry()
+
+
+def duckdb_cursor(con):
+    """DuckDB cursor to run queries on, con is a SQLAlchemy connection or a DuckDB connection/cursor"""
+    if isinstance(con, duckdb.DuckDBPyConnection):
+        return con
+    return con.connection.cursor()
+
+
+def get_sql_from_template(con, query, bind_params=None, verbose=False, arrow=False):
     """
+    Run Jinja template query against con, substituting bind_params.
+    Runs on DuckDB's own cursor under the SQLAlchemy connection and fetches the result as Arrow,
+    skipping pd.read_sql's row by row DBAPI conversion. Returns a DataFrame, or the pyarrow Table if arrow is set.
+    """
+    query_vals = None
     if not bind_params:
         if verbose:
             print(query)
-        return pd.read_sql(query, con)
-
-    # process bind_params
-    if verbose:
-        # copy and escape params for legibility
-        params = deepcopy(bind_params)
-        for key, val in params.items():
-            params[key] = quote_sql_string(val)
-        query_str, query_vals = JinjaSql().prepare_query(query, params)
-        print(query_str % tuple(query_vals))
-
-    # process params using ? style, run query, return dataframe
-    query_str, query_vals = JinjaSql(param_style='qmark').prepare_query(query, bind_params)
-    return pd.read_sql(query_str, con, params=query_vals)
+        query_str = query
+    else:
+        # process params using ? style
+        query_str, query_vals = templates.prepare_query(query, bind_params)
+        if verbose:
+            # escape params for legibility
+            print(query_str.replace('?', '%s') % tuple(quote_sql_string(v) for v in query_vals))
+
+    # run query on the DuckDB connection, return dataframe or arrow table
+    cursor = duckdb_cursor(con)
+    if query_vals:
+        cursor.execute(query_str, list(query_vals))
+    else:
+        cursor.execute(query_str)
+    table = cursor.arrow()
+    # DuckDB >= 1.4 returns a RecordBatchReader
+    if isinstance(table, pa.RecordBatchReader):
+        table = table.read_all()
+    return table if arrow else arrow_df(table)
 
 
 def stations_fn(con, verbose=False):
@@ -92,303 +218,212 @@ def stations_fn(con, verbose=False):
     return df['pretty_name'].to_list()
 
 
-def create_filter_current(con, filters, verbose=False):
-    """make temp table filter_current from filters (just filter, no group by)"""
+def station_geometry(con, verbose=False):
+    "return name and location of each station for the map, in station_list order"
+    return get_sql_from_template(con, 'select pretty_name, latitude "Latitude", longitude "Longitude" '
+                                      'from station_list order by station;', verbose=verbose)
 
-    print("filter_current")
-    query = """
-    create or replace temp table filter_current as
-    select
-        date,
-        datepart('dow', date) dow,
-        hour,
-        station,
-        boro,
-        entries,
-        exits
+
+# the dashboard reads the rollup tables built by dbt (dbt_mta/models/rollup_*.sql), not mta_clean
+# rollup_daily has no hour, rollup_hourly is used when filtering or grouping by time of day
+def current_cte(name="current", source="{% if hourly or tod %} rollup_hourly {% else %} rollup_daily {% endif %}"):
+    """CTE name of the rows of source selected by filters"""
+    return """
+    """ + name + """ as
+    (select *
     from
-        mta_clean
+        """ + source + """
     where
         TRUE
         {% if startdate %} and date >= {{startdate}} {% endif %}
         {% if enddate %} and date < {{enddate}} {% endif %}
-        {% if dow %} and date_part('dow', date) in {{ dow | inclause }}  {% endif %}
+        {% if dow %} and dow in {{ dow | inclause }} {% endif %}
         {% if tod %} and hour in {{ tod | inclause }} {% endif %}
         {% if boro %} and boro in {{ boro | inclause }} {% endif %}
         {% if sta %} and station in {{ sta | inclause }} {% endif %}
-    """
+    )
+"""
 
-    return get_sql_from_template(con, query, filters, verbose=verbose)
 
+CURRENT_CTE = current_cte()
 
-def create_filter_2019(con, filters, verbose=False):
-    """make temp table filter_2019 from filters (just filter, no group by)"""
+# baseline filters: rollup_baseline column -> filters key
+BASELINE_FILTERS = {'dow': 'dow', 'hour': 'tod', 'boro': 'boro', 'station': 'sta'}
 
-    query = """
-    create or replace temp table filter_2019 as
-    select
-        date,
-        datepart('dow', date) dow,
-        hour,
-        station,
-        boro,
-        entries,
-        exits
-    from
-        mta_clean
-    where
-        date_part('year', DATE)=2019
-        {% if dow %} and date_part('dow', date) in {{ dow | inclause }}  {% endif %}
-        {% if tod %} and hour in {{ tod | inclause }} {% endif %}
-        {% if boro %} and boro in {{ boro | inclause }} {% endif %}
-        {% if sta %} and station in {{ sta | inclause }} {% endif %}
-    """
 
-    return get_sql_from_template(con, query, filters, verbose=verbose)
+class Baselines:
+    """
+    2019 and pandemic baselines, rollup_baseline held in memory.
+    rollup_baseline is built once per dbt build at (period, dow, hour, station) grain,
+    it's read again only when the build generation changes.
+    """
 
+    def __init__(self):
+        self.generation = None
+        self.df = None
+        self.lock = threading.Lock()
 
-def create_filter_pandemic(con, filters, verbose=False):
-    """make temp table filter_pandemic from filters (just filter, no group by)"""
+    def get(self, con, generation, verbose=False):
+        with self.lock:
+            if self.df is None or generation > self.generation:
+                self.df = get_sql_from_template(con, "select * from rollup_baseline", None, verbose=verbose)
+                self.generation = generation
+            elif generation < self.generation:
+                # a request still on the database before the last publish
+                return get_sql_from_template(con, "select * from rollup_baseline", None, verbose=verbose)
+            return self.df
 
-    query = """
-    create or replace temp table filter_pandemic as
-    select
-        date,
-        datepart('dow', date) dow,
-        hour,
-        station,
-        boro,
-        entries,
-        exits
-    from
-        mta_clean
-    where
-        date >= '2020-04-01' and date < '2021-04-01'
-        {% if dow %} and date_part('dow', date) in {{ dow | inclause }}  {% endif %}
-        {% if tod %} and hour in {{ tod | inclause }} {% endif %}
-        {% if boro %} and boro in {{ boro | inclause }} {% endif %}
-        {% if sta %} and station in {{ sta | inclause }} {% endif %}
-    """
 
-    return get_sql_from_template(con, query, filters, verbose=verbose)
+baselines = Baselines()
 
 
-def agg_station(con, source, verbose=False):
-    """make temp table %source%_daily, group by station, aggregate by day"""
-    query = """
-    create or replace temp table {source}_daily as
-    select
-        date,
-        dow,
-        station,
-        boro,
-        sum(entries) entries,
-        sum(exits) exits
-    from
-        {source}
-    group by
-        date,
-        dow,
-        station,
-        boro,
-    """.format(source=source)
+def filter_baseline(df, filters):
+    """rows of rollup_baseline matching filters (dates don't apply to baselines)"""
+    mask = pd.Series(True, index=df.index)
+    for column, key in BASELINE_FILTERS.items():
+        if filters.get(key):
+            mask &= df[column].isin(filters[key])
+    return df[mask]
 
-    return get_sql_from_template(con, query, None, verbose=verbose)
 
+def baseline_avg(df, by=None):
+    """
+    average day of filtered baseline df by period (and by, if given): sum / dates with data.
+    The dates with data for a day of week are the weeks any of its rows has data in (the bits of weeks),
+    dates of different days of week are different dates, so those counts add up.
+    """
+    keys = ['period'] + ([by] if by else [])
+    dow_keys = keys if by == 'dow' else keys + ['dow']
+    df = df.groupby(dow_keys, sort=False, observed=True).agg(
+        {'entries': 'sum', 'exits': 'sum', 'weeks': np.bitwise_or.reduce})
+    df['days'] = df['weeks'].map(lambda weeks: bin(weeks).count('1'))
+    df = df.groupby(level=keys, sort=False, observed=True)[['entries', 'exits', 'days']].sum().reset_index()
+    df['entries'] = df['entries'] / df['days']
+    df['exits'] = df['exits'] / df['days']
+    return df.rename(columns={'days': 'n'})
+
+
+AVG_QUERY = "with " + CURRENT_CTE + """
+    select avg(entries) entries from (select date, sum(entries) entries from current group by date)
+    """
 
-def create_filter_current_daily(con, verbose=False):
-    """make temp table filter_current_daily, group by station, aggregate by day"""
-    return agg_station(con, "filter_current", verbose=verbose)
 
+def avg_entries(con, filters, baseline, verbose=False):
+    """return average daily entries for the selection, pandemic and 2019"""
+    return avg_with_baseline(get_sql_from_template(con, AVG_QUERY, filters, verbose=verbose).iloc[0, 0], baseline)
 
-def create_filter_2019_daily(con, verbose=False):
-    """make temp table filter_2019_daily, group by station, aggregate by day"""
-    return agg_station(con, "filter_2019", verbose=verbose)
 
+def avg_with_baseline(entries_selection, baseline):
+    """average daily entries for the selection and the baselines"""
+    df = baseline_avg(baseline).set_index('period')['entries']
+    return pd.Series({
+        'entries_selection': entries_selection,
+        'entries_pandemic': df.get('Pandemic'),
+        'entries_2019': df.get('2019'),
+    })
 
-def create_filter_pandemic_daily(con, verbose=False):
-    """make temp table filter_current_daily, group by station, aggregate by day"""
-    return agg_station(con, "filter_pandemic", verbose=verbose)
 
+def query_value(con, query, verbose=False):
+    """return a single query value"""
+    return get_sql_from_template(con, query, None, verbose=verbose).iloc[0][0]
 
-def agg_summary(con, source, verbose=False):
-    """make temp table %source%_summary, aggregate by date (all stations)"""
 
-    query = """
-    create or replace temp table {source}_summary as
+BY_DATE_QUERY = "with " + CURRENT_CTE + """
     select
         date,
-        dow,
         sum(entries) entries,
         sum(exits) exits
-    from
-        {source}_daily
-    group by
-        date,
-        dow,
-    """.format(source=source)
-
-    return get_sql_from_template(con, query, None, verbose=verbose)
-
-
-def create_filter_current_summary(con, verbose=False):
-    """make temp table filter_current_day, group by station, aggregate by day"""
-    return agg_summary(con, "filter_current", verbose=verbose)
+    from current
+    group by date
+    order by date
+    """
 
 
-def create_filter_2019_summary(con, verbose=False):
-    """make temp table filter_2019_day, group by station, aggregate by day"""
-    return agg_summary(con, "filter_2019", verbose=verbose)
+def entries_by_date(con, filters, verbose=False):
+    """return dataframe of all entries by date, subject to filters"""
+    return get_sql_from_template(con, BY_DATE_QUERY, filters, verbose=verbose)
 
 
-def create_filter_pandemic_summary(con, verbose=False):
-    """make temp table filter_pandemic_day, group by station, aggregate by day"""
-    return agg_summary(con, "filter_pandemic", verbose=verbose)
+def with_baseline(df, baseline, by):
+    """Selected rows df plus the baselines by dow or hour, ordered 2019, Selected, Pandemic, then by"""
+    base = baseline_avg(baseline, by).rename(columns={'period': 'when'})
+    df = pd.concat([df, base[df.columns]], ignore_index=True).sort_values(by, kind='stable')
+    order = {'2019': 1, 'Selected': 2, 'Pandemic': 3}
+    return df.sort_values('when', key=lambda s: s.map(order), kind='stable').reset_index(drop=True)
 
 
-def query_value(con, query, verbose=False):
-    """return a single query value"""
-    return get_sql_from_template(con, query, None, verbose=verbose).iloc[0][0]
+def station_with_baseline(df, baseline):
+    """station averages df plus the baseline averages of each station"""
+    base = baseline_avg(baseline, 'station')
+    for period, suffix in [('Pandemic', 'pandemic'), ('2019', '2019')]:
+        columns = {'station': 'pretty_name', 'entries': 'entries_' + suffix, 'exits': 'exits_' + suffix}
+        df = df.merge(base[base['period'] == period].rename(columns=columns)[list(columns.values())],
+                      on='pretty_name')
+    return df
 
 
-def entries_by_date(con, verbose=False):
-    """return dataframe of all entries by date, subject to filters"""
-    query = "select date, entries, exits from filter_current_summary order by date"
-    return get_sql_from_template(con, query, None, verbose=verbose)
+BY_DOW_QUERY = "with " + CURRENT_CTE + """,
+    current_summary as
+    (select
+        date,
+        dow,
+        sum(entries) entries,
+        sum(exits) exits
+    from current
+    group by
+        date,
+        dow
+    )
+    select
+        'Selected' as when,
+        count(*) n,
+        dow,
+        sum(entries)/n as entries,
+        sum(exits)/n as exits
+    from current_summary
+    group by
+        dow
+    """
 
 
-def entries_by_dow(con, verbose=False):
+def entries_by_dow(con, filters, baseline, verbose=False):
     """return dataframe of all entries by day of week, comps, subject to filters"""
+    return with_baseline(get_sql_from_template(con, BY_DOW_QUERY, filters, verbose=verbose), baseline, 'dow')
 
-    query = """
-        with dow_query as
-        ((select
-            'Pandemic' as when,
-            count(*) n,
-            dow,
-            sum(entries)/n as entries,
-            sum(exits)/n as exits
-        from filter_pandemic_summary
-        group by
-            dow
-        )
-
-        union
-
-        (select
-            'Selected' as when,
-            count(*) n,
-            dow,
-            sum(entries)/n as entries,
-            sum(exits)/n as exits
-        from filter_current_summary
-        group by
-            dow
-        )
-
-        union
-
-        (select
-            '2019' as when,
-            count(*) n,
-            dow,
-            sum(entries)/n as entries,
-            sum(exits)/n as exits
-        from filter_2019_summary
-        group by
-            dow
-        ))
-        select * from dow_query
-        order by case "when" when '2019' then 1 when 'Selected' then 2 when 'Pandemic' then 3 end
-    """
-    df = get_sql_from_template(con, query, None, verbose=verbose)
-    return df
-
-
-def entries_by_tod(con, verbose=False):
-    """return dataframe of all entries by time of day, subject to filters"""
 
-    query = """
-    with tod_subquery as (
-        (with pand as
-            (select
-                date,
-                hour,
-                sum(entries) as entries,
-                sum(exits) as exits
-            from filter_pandemic
-            group by
-                date,
-                hour)
-        select 'Pandemic' as when, hour, count(*) n, sum(entries)/n as entries, sum(exits)/n as exits from pand group by hour)
-
-        union
-
-        (with cur as
-            (select
-                date,
-                hour,
-                sum(entries) as entries,
-                sum(exits) as exits
-            from filter_current
-            group by
-                date,
-                hour)
-        select 'Selected' as when, hour, count(*) n, sum(entries)/n as entries, sum(exits)/n as exits from cur group by hour)
-
-        union
-
-        (with f19 as
-            (select
-                date,
-                hour,
-                sum(entries) as entries,
-                sum(exits) as exits
-            from filter_2019
-            group by
-                date,
-                hour)
-        select '2019' as when, hour, count(*) n, sum(entries)/n as entries, sum(exits)/n as exits from f19 group by hour)
+BY_TOD_QUERY = "with " + CURRENT_CTE + """,
+    cur as
+    (select
+        date,
+        hour,
+        sum(entries) as entries,
+        sum(exits) as exits
+    from current
+    group by
+        date,
+        hour
     )
-    select * from tod_subquery
-    order by case "when" when '2019' then 1 when 'Selected' then 2 when 'Pandemic' then 3 end
-
+    select 'Selected' as when, hour, count(*) n, sum(entries)/n as entries, sum(exits)/n as exits
+    from cur
+    group by hour
     """
 
-    return get_sql_from_template(con, query, None, verbose=verbose)
 
+def entries_by_tod(con, filters, baseline, verbose=False):
+    """return dataframe of all entries by time of day, subject to filters"""
+    return with_baseline(get_sql_from_template(con, BY_TOD_QUERY, dict(filters, hourly=True), verbose=verbose),
+                         baseline, 'hour')
 
-def entries_by_station(con, verbose=False):
 
-    query = """
-    with cur as
+BY_STATION_QUERY = "with " + CURRENT_CTE + """,
+    cur as
     (SELECT
         station,
         count(*) n,
         sum(entries)/n entries,
         sum(exits)/n exits
     from
-        filter_current_daily
-        group by station
-    ),
-    pand as
-    (SELECT
-        station,
-        count(*) n,
-        sum(entries)/n entries,
-        sum(exits)/n exits
-    from
-        filter_pandemic_daily
-        group by station
-    ),
-    f19 as
-    (SELECT
-        station,
-        count(*) n,
-        sum(entries)/n entries,
-        sum(exits)/n exits
-    from
-        filter_2019_daily
+        (select date, station, sum(entries) entries, sum(exits) exits from current group by date, station)
         group by station
     )
     select
@@ -396,19 +431,351 @@ def entries_by_station(con, verbose=False):
         latitude,
         longitude,
         cur.entries entries_selection,
-        cur.exits exits_selection,
-        pand.entries entries_pandemic,
-        pand.exits exits_pandemic,
-        f19.entries entries_2019,
-        f19.exits exits_2019
+        cur.exits exits_selection
     from
         station_list
         join cur on station_list.pretty_name = cur.station
-        join f19 on station_list.pretty_name = f19.station
-        join pand on station_list.pretty_name = pand.station
     order by station_list.station;
     """
-    return get_sql_from_template(con, query, None, verbose=verbose)
+
+
+def entries_by_station(con, filters, baseline, verbose=False):
+    return station_with_baseline(get_sql_from_template(con, BY_STATION_QUERY, filters, verbose=verbose), baseline)
+
+
+# all the Selected results in one statement, each result set is returned as a list of structs in a single row
+# the panels share one scan of rollup_daily (or rollup_hourly with a time of day filter),
+# only time of day needs its own scan of rollup_hourly
+FUSED_QUERY = "with " + CURRENT_CTE + "," + current_cte("current_hourly", "rollup_hourly") + """,
+    daily as materialized
+    (select
+        date,
+        dow,
+        station,
+        sum(entries) entries,
+        sum(exits) exits
+    from current
+    group by
+        date,
+        dow,
+        station
+    ),
+    summary as materialized
+    (select
+        date,
+        dow,
+        sum(entries) entries,
+        sum(exits) exits
+    from daily
+    group by
+        date,
+        dow
+    ),
+    by_date as
+    (select date, entries, exits from summary),
+    by_dow as
+    (select 'Selected' as when, count(*) n, dow, sum(entries)/n as entries, sum(exits)/n as exits
+    from summary
+    group by dow
+    ),
+    by_tod as
+    (select 'Selected' as when, hour, count(*) n, sum(entries)/n as entries, sum(exits)/n as exits
+    from (select date, hour, sum(entries) entries, sum(exits) exits from current_hourly group by date, hour)
+    group by hour
+    ),
+    by_station as
+    (select
+        station_list.station station_order,
+        station_list.pretty_name,
+        latitude "Latitude",
+        longitude "Longitude",
+        cur.entries entries_selection,
+        cur.exits exits_selection
+    from
+        station_list
+        join (select station, count(*) n, sum(entries)/n entries, sum(exits)/n exits from daily group by station) cur
+            on station_list.pretty_name = cur.station
+    )
+select
+    (select avg(entries) from summary) entries_selection,
+    (select list(by_date order by date) from by_date) by_date,
+    (select list(by_dow order by dow) from by_dow) by_dow,
+    (select list(by_tod order by hour) from by_tod) by_tod,
+    (select list(by_station order by station_order) from by_station) by_station
+"""
+
+FUSED_COLUMNS = {
+    'by_date': ['date', 'entries', 'exits'],
+    'by_dow': ['when', 'n', 'dow', 'entries', 'exits'],
+    'by_tod': ['when', 'hour', 'n', 'entries', 'exits'],
+    'by_station': ['pretty_name', 'Latitude', 'Longitude', 'entries_selection', 'exits_selection'],
+}
+
+# compile the dashboard queries once at import, callbacks only render (once per filter shape) and bind
+for query in [AVG_QUERY, BY_DATE_QUERY, BY_DOW_QUERY, BY_TOD_QUERY, BY_STATION_QUERY, FUSED_QUERY]:
+    templates.compile(query)
+
+
+def fused_results(con, filters, baseline, verbose=False):
+    """all dashboard results from FUSED_QUERY, same as the separate queries"""
+    table = get_sql_from_template(con, FUSED_QUERY, filters, verbose=verbose, arrow=True)
+    # each list of structs unnests into a table in Arrow, without building python dicts per row
+    df = {}
+    for key, columns in FUSED_COLUMNS.items():
+        structs = table.column(key)[0].values
+        df[key] = arrow_df(pa.Table.from_struct_array(structs).select(columns)) if structs is not None \
+            else pd.DataFrame([], columns=columns)
+    return {
+        'avg': avg_with_baseline(table.column('entries_selection')[0].as_py(), baseline),
+        'by_date': df['by_date'],
+        'by_tod': with_baseline(df['by_tod'], baseline, 'hour'),
+        'by_dow': with_baseline(df['by_dow'], baseline, 'dow'),
+        'by_station': station_with_baseline(df['by_station'], baseline),
+    }
+
+
+######################################################################
+# result cache
+######################################################################
+
+
+def filters_key(filters):
+    """canonical hash of filters, the same selection in any order gives the same key"""
+    canonical = {k: sorted(v) if isinstance(v, list) else v for k, v in filters.items() if v}
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def build_generation(con, path, verbose=False):
+    """generation stamped by the dbt build of the db file path, or its mtime if it has no build_generation"""
+    try:
+        return get_sql_from_template(con, "select generation from build_generation", None, verbose=verbose).iloc[0, 0]
+    except Exception:
+        return str(os.path.getmtime(path))
+
+
+class Database:
+    """
+    The published database. The build publishes a new versioned file by swapping the DATAPATH symlink
+    (mta_publish.py), each request checks the link and a new target gets a new engine.
+    Requests in flight finish on the old engine's connections, which close as they are returned.
+    Generations are (serial, build generation), ordered so caches can tell newer from older.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.target = None
+        self.engine = None
+        self.generation = None
+        self.serial = 0
+        self.lock = threading.Lock()
+
+    def current(self, verbose=False):
+        """(engine, generation) for a request"""
+        target = os.path.realpath(self.path)
+        with self.lock:
+            if target != self.target:
+                old_engine = self.engine
+                engine = sqlalchemy.create_engine('duckdb:////%s' % target, pool_size=POOL_SIZE,
+                                                  connect_args={'read_only': True, 'config': DUCKDB_SETTINGS})
+                with engine.connect() as con:
+                    generation = build_generation(con, target, verbose=verbose)
+                self.serial += 1
+                self.target, self.engine, self.generation = target, engine, (self.serial, generation)
+                if old_engine is not None:
+                    print("%s - database published, switching to %s" % (strftime("%H:%M:%S"), target))
+                    old_engine.dispose()
+            return self.engine, self.generation
+
+
+database = Database(DATAPATH)
+
+
+def result_size(results):
+    """approximate bytes held by a DataFrame, a Series or a dict of them"""
+    if isinstance(results, dict):
+        return sum([result_size(v) for v in results.values()])
+    usage = results.memory_usage(deep=True)
+    return int(usage.sum()) if isinstance(results, pd.DataFrame) else int(usage)
+
+
+class ResultCache:
+    """
+    LRU cache of query results keyed by filters_key (and result name in separate mode).
+    Evicts least recently used results beyond max_entries or max_bytes,
+    and empties itself when the db's build generation changes.
+    Concurrent get_or_compute(_many) calls for the same key run the queries once, the others wait for the result.
+    """
+
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_MB * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation = None
+        self.results = OrderedDict()
+        self.sizes = {}
+        self.pending = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def check_generation(self, generation):
+        """empty the cache for a newer generation, False for a request still on an older one"""
+        if self.generation is None or generation > self.generation:
+            if self.results:
+                print("%s - db rebuilt, clearing %d cached results" % (strftime("%H:%M:%S"), len(self.results)))
+            self.results.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+            self.generation = generation
+        return generation == self.generation
+
+    def get(self, key, generation):
+        with self.lock:
+            if not self.check_generation(generation) or key not in self.results:
+                return None
+            self.results.move_to_end(key)
+            return self.results[key]
+
+    def put(self, key, generation, results):
+        size = result_size(results)
+        with self.lock:
+            if not self.check_generation(generation):
+                return
+            if key in self.results:
+                self.nbytes -= self.sizes.pop(key)
+                del self.results[key]
+            if size > self.max_bytes:
+                return
+            self.results[key] = results
+            self.sizes[key] = size
+            self.nbytes += size
+            while len(self.results) > self.max_entries or self.nbytes > self.max_bytes:
+                oldest, _ = self.results.popitem(last=False)
+                self.nbytes -= self.sizes.pop(oldest)
+
+    def get_or_compute(self, key, generation, compute):
+        """cached result for key, or compute() it, once for all concurrent callers"""
+        return self.get_or_compute_many([key], generation, lambda missing: {key: compute()})[key]
+
+    def get_or_compute_many(self, keys, generation, compute):
+        """
+        {key: result} for keys from the cache, waiting on keys another caller is computing.
+        The rest are computed in one batch, compute(missing keys) returns {key: result}.
+        """
+        results = {}
+        waiting = {}
+        owned = {}
+        with self.lock:
+            current = self.check_generation(generation)
+            for key in keys:
+                if current and key in self.results:
+                    self.results.move_to_end(key)
+                    results[key] = self.results[key]
+                elif current and (generation, key) in self.pending:
+                    waiting[key] = self.pending[(generation, key)]
+                else:
+                    owned[key] = Future()
+                    # the db was published since this request started, don't cache its results
+                    if current:
+                        self.pending[(generation, key)] = owned[key]
+        if owned:
+            try:
+                computed = compute(list(owned))
+                for key, pending in owned.items():
+                    if current:
+                        self.put(key, generation, computed[key])
+                    pending.set_result(computed[key])
+                    results[key] = computed[key]
+            except Exception as exc:
+                for pending in owned.values():
+                    if not pending.done():
+                        pending.set_exception(exc)
+                raise
+            finally:
+                if current:
+                    with self.lock:
+                        for key in owned:
+                            del self.pending[(generation, key)]
+        for key, pending in waiting.items():
+            results[key] = pending.result()
+        return results
+
+
+result_cache = ResultCache()
+
+
+query_executor = ThreadPoolExecutor(max_workers=QUERY_THREADS, thread_name_prefix='query')
+
+
+def run_concurrently(con, tasks):
+    """
+    Run independent tasks {name: fn(cursor)} on query_executor, each on its own DuckDB cursor of con.
+    Returns {name: result}. Logs the wall time against the critical path (the slowest task)
+    and the sum of the tasks, wall time near the critical path means the queries overlapped.
+    A failed task raises once all have finished, so none is left running on con after it's returned to the pool.
+    """
+    def timed(fn):
+        start = perf_counter()
+        with duckdb_cursor(con).cursor() as cursor:
+            result = fn(cursor)
+        return result, perf_counter() - start
+
+    start = perf_counter()
+    futures = {name: query_executor.submit(timed, fn) for name, fn in tasks.items()}
+    wait(futures.values())
+    results = {name: future.result() for name, future in futures.items()}
+    wall = perf_counter() - start
+
+    slowest = max(results, key=lambda name: results[name][1])
+    print("%s - %d queries in %.0f ms, critical path %s %.0f ms, sum %.0f ms" %
+          (strftime("%H:%M:%S"), len(tasks), wall * 1000, slowest, results[slowest][1] * 1000,
+           sum([t for _, t in results.values()]) * 1000))
+    return {name: result for name, (result, _) in results.items()}
+
+
+# results of the dashboard queries, each panel callback asks for the ones it shows
+RESULTS = ['avg', 'by_date', 'by_tod', 'by_dow', 'by_station']
+
+
+def separate_queries(filters, baseline, verbose=False):
+    """{result name: fn(con)} running the separate query for each result"""
+    return {
+        'avg': lambda con: avg_entries(con, filters, baseline, verbose=verbose),
+        'by_date': lambda con: entries_by_date(con, filters, verbose=verbose),
+        'by_tod': lambda con: entries_by_tod(con, filters, baseline, verbose=verbose),
+        'by_dow': lambda con: entries_by_dow(con, filters, baseline, verbose=verbose),
+        'by_station': lambda con: entries_by_station(con, filters, baseline, verbose=verbose),
+    }
+
+
+def query_results(con, filters, generation, names=RESULTS, verbose=False):
+    """run the dashboard queries for results names, baselines come from memory. fused mode returns all results"""
+    baseline = filter_baseline(baselines.get(con, generation, verbose=verbose), filters)
+    if QUERY_MODE == 'fused':
+        return fused_results(con, filters, baseline, verbose=verbose)
+    queries = separate_queries(filters, baseline, verbose=verbose)
+    if len(names) == 1:
+        return {names[0]: queries[names[0]](con)}
+    return run_concurrently(con, {name: queries[name] for name in names})
+
+
+def cached_results(con, generation, filters, names=RESULTS, verbose=False):
+    """
+    results names for filters from result_cache, running the queries on a miss.
+    fused mode caches all the results for filters as one entry, separate mode caches each result
+    on its own so a panel only waits for its own queries, a panel's misses run concurrently.
+    """
+    key = filters_key(filters)
+    if QUERY_MODE == 'fused':
+        results = result_cache.get_or_compute(key, generation,
+                                              lambda: query_results(con, filters, generation, verbose=verbose))
+        return {name: results[name] for name in names}
+
+    def compute(missing):
+        results = query_results(con, filters, generation, [name for _, name in missing], verbose=verbose)
+        return {(key, name): results[name] for _, name in missing}
+
+    results = result_cache.get_or_compute_many([(key, name) for name in names], generation, compute)
+    return {name: results[(key, name)] for name in names}
+
 
 ######################################################################
 # output panels as elements
@@ -450,21 +817,17 @@ def ma_input(value=7):
     return dcc.Input(value=value, min=1, size="8", className="ma_value_input", id="ma_value_input")
 
 
-def fig1(df_entries_by_date, ma_interval):
-
-    ma_interval = int(ma_interval)
-    if ma_interval is None or ma_interval < 1:
-        ma_interval = 1
-
-    entries_desc = 'Entries (%d-day MA) ' % ma_interval
-    exits_desc = 'Exits (%d-day MA) ' % ma_interval
-    df_entries_by_date[entries_desc] = df_entries_by_date['entries'].rolling(ma_interval).mean()
-    df_entries_by_date[exits_desc] = df_entries_by_date['exits'].rolling(ma_interval).mean()
-
-    fig = px.line(df_entries_by_date, x="date", y=[entries_desc, exits_desc], height=360,
-                  color_discrete_sequence=plotly.colors.qualitative.Dark24)
-    fig.update_traces(line=dict(width=2))
+def fig1():
+    """
+    entries and exits by date, the data comes from the by_date store.
+    The moving averages are computed in the browser (assets/moving_average.js),
+    so changing ma_value_input redraws the chart without a server round trip.
+    """
+    fig = go.Figure([go.Scatter(x=[], y=[], name=name, legendgroup=name, mode='lines',
+                                line=dict(color=color, width=2))
+                     for name, color in zip(['Entries', 'Exits'], plotly.colors.qualitative.Dark24)])
     fig.update_layout(
+        height=360,
         margin={'l': 10, 'r': 15, 't': 10},
         paper_bgcolor="white",
         # plot_bgcolor="white",
@@ -513,6 +876,7 @@ def fig1(df_entries_by_date, ma_interval):
 
 def fig2(df_entries_by_dow):
     """entries by day of week"""
+    df_entries_by_dow = df_entries_by_dow.copy()
     df_entries_by_dow['Weekday'] = df_entries_by_dow['dow'].apply(lambda i: dowinvmap[i])
 
     fig = px.bar(df_entries_by_dow[['Weekday', 'when', 'entries']],
@@ -620,12 +984,24 @@ def fig3(df_entries_by_tod):
     return dcc.Graph(id='entries-tod', animate=False, figure=fig)
 
 
-def fig_table(df):
-    temp_df = df[['pretty_name', 'entries_selection', 'entries_pandemic', 'entries_2019']].copy()
-    temp_df['pct_v_2019'] = temp_df['entries_selection'] / temp_df['entries_2019'] - 1
-    temp_df['pct_v_pandemic'] = temp_df['entries_selection'] / temp_df['entries_pandemic'] - 1
-    temp_df.rename(columns={'pretty_name': 'station', 'entries_selection': 'entries'}, inplace=True)
+def station_changes(df):
+    """entries and change vs. 2019 and pandemic of each station in entries_by_station df"""
+    df = df[['pretty_name', 'entries_selection', 'entries_pandemic', 'entries_2019']].copy()
+    df['pct_v_2019'] = df['entries_selection'] / df['entries_2019'] - 1
+    df['pct_v_pandemic'] = df['entries_selection'] / df['entries_pandemic'] - 1
+    return df
 
+
+def table_data(df):
+    """fig_table rows for station_changes df, rounded to what the table shows"""
+    df = df.rename(columns={'pretty_name': 'station', 'entries_selection': 'entries'})
+    df = df[['station', 'entries', 'pct_v_2019', 'pct_v_pandemic']]
+    df = df.round({'entries': 1, 'pct_v_2019': 4, 'pct_v_pandemic': 4})
+    return df.astype({'station': str}).to_dict('records')
+
+
+def fig_table():
+    """station table, created once empty, update_stations sends only its data"""
     table = dash_table.DataTable(
         id='fig_table',
         columns=[
@@ -637,7 +1013,7 @@ def fig_table(df):
             {"name": '%Ch vs. Pandemic', "id": 'pct_v_pandemic', "deletable": False, "selectable": False,
              "type": "numeric", "format": FormatTemplate.percentage(1)},
         ],
-        data=temp_df.to_dict('records'),
+        data=[],
         editable=False,
         filter_action="native",
         sort_action="native",
@@ -685,36 +1061,56 @@ def fig_table(df):
     return table
 
 
-def fig_map(df, mapbox_token):
+MAP_SIZE_MAX = 20
+MAP_HOVER = ("<b>%{hovertext}</b><br><br>Entries=%{customdata[0]:,.0f}<br>"
+             "%Ch vs. 2019=%{customdata[1]:.1%}<br>%Ch vs. pandemic=%{customdata[2]:.1%}<extra></extra>")
 
-    df = df[['pretty_name', 'Latitude', 'Longitude', 'entries_selection',
-             'entries_pandemic', 'entries_2019',]].copy()
-    df['pct_ch_vs_2019'] = df['entries_selection'] / df['entries_2019'] - 1
-    df['%Ch vs. 2019'] = df["pct_ch_vs_2019"].apply(lambda f: "{0:.1%}".format(f))
-    df['pct_ch_vs_pandemic'] = df['entries_selection'] / df['entries_pandemic'] - 1
-    df['%Ch vs. pandemic'] = df["pct_ch_vs_pandemic"].apply(lambda f: "{0:.1%}".format(f))
-    df['Entries'] = df['entries_selection'].apply(lambda f: '{:,}'.format(f))
-    df.rename(columns={'pretty_name': 'Station'}, inplace=True)
+
+def fig_map(geometry, mapbox_token):
+    """
+    station map, created once with every station's location, name and the styling.
+    update_stations patches in only the numbers (map_patch), stations outside the selection get size 0.
+    """
+    df = geometry.rename(columns={'pretty_name': 'Station'}).astype({'Station': str})
+    df['entries_selection'] = 1.0
+    df['pct_ch_vs_2019'] = 0.0
 
     fig = px.scatter_mapbox(
         df,
         lat="Latitude",
         lon="Longitude",
         hover_name="Station",
-        hover_data={"Entries": True, "Latitude": False, "Longitude": False,
-                    "%Ch vs. 2019": True, "%Ch vs. pandemic": True,
-                    "entries_2019": False, "entries_pandemic": False,
-                    "pct_ch_vs_2019": False, "pct_ch_vs_pandemic": False,
-                    "entries_selection": False},
-        size="entries_selection", size_max=20,
+        size="entries_selection", size_max=MAP_SIZE_MAX,
         color_continuous_scale=px.colors.sequential.YlGnBu, color="pct_ch_vs_2019",
         zoom=10, height=480)
+    fig.update_traces(hovertemplate=MAP_HOVER)
     fig.update_layout(mapbox_style="carto-darkmatter", mapbox_accesstoken=mapbox_token)
     fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0}, showlegend=False)
 
     return dcc.Graph(id='fig_map', animate=False, figure=fig)
 
 
+def map_patch(geometry, df):
+    """Patch for fig_map's marker size and color and hover numbers from station_changes df"""
+    df = geometry[['pretty_name']].astype(str).merge(
+        df.astype({'pretty_name': str}).drop_duplicates('pretty_name'), on='pretty_name', how='left')
+    selected = df['entries_selection'].notna()
+    size = df['entries_selection'].where(selected, 0).round(1)
+
+    def values(column, decimals):
+        return [v if ok else None for v, ok in zip(df[column].round(decimals), selected)]
+
+    patch = Patch()
+    patch['data'][0]['marker']['size'] = size.tolist()
+    # px sizes markers by area with sizeref = 2 * max / size_max ** 2
+    patch['data'][0]['marker']['sizeref'] = 2.0 * (size.max() or 1) / MAP_SIZE_MAX ** 2
+    patch['data'][0]['marker']['color'] = values('pct_v_2019', 4)
+    patch['data'][0]['customdata'] = [list(row) for row in zip(values('entries_selection', 1),
+                                                               values('pct_v_2019', 4),
+                                                               values('pct_v_pandemic', 4))]
+    return patch
+
+
 ######################################################################
 # generate content
 ######################################################################
@@ -815,6 +1211,10 @@ def generate_content(filters=None):
                 html.Button(id='submit-button-state', className='btn btn-primary', n_clicks=0, children='Submit')
                 ])
             ]),
+        # filters set by Submit, each output panel's callback runs off this
+        dcc.Store(id='filters'),
+        # daily entries and exits for the moving average chart, sent once per Submit
+        dcc.Store(id='by_date'),
         # dbc.Row([
         #     dbc.Col(xl=1),  # gutter on xl and larger
         #     dbc.Col(html.Div(id='output-state'))
@@ -854,15 +1254,17 @@ def generate_content(filters=None):
             ]),
         dbc.Row([
             dbc.Col(xl=1),  # gutter on xl and larger
-            dbc.Col(className="chart-header", id='fig1'),
+            dbc.Col(className="chart-header", id='fig1', children=fig1()),
             dbc.Col(className="chart-header", id='fig2'),
             dbc.Col(className="chart-header", id='fig3'),
             dbc.Col(xl=1),  # gutter on xl and larger
             ]),
         dbc.Row([
                 dbc.Col(xl=1),
-                dbc.Col(id='fig_table_parent'),
-                dbc.Col(id='fig_map_parent'),
+                dbc.Col(id='fig_table_parent',
+                        children=[fig_table(), html.Div(id='datatable-interactivity-container')]),
+                dbc.Col(id='fig_map_parent',
+                        children=["Station map, size=entries, color=%ch from 2019", fig_map(geometry, mapbox_token)]),
                 dbc.Col(xl=1),
                 ]),
     ]
@@ -873,7 +1275,11 @@ def generate_content(filters=None):
 ######################################################################
 
 # global variable, only query on startup
-stations = stations_fn(con, verbosity)
+# the station list and map locations are read at startup, restart the app after adding stations
+engine, _ = database.current(verbose=verbosity)
+with engine.connect() as con:
+    stations = stations_fn(con, verbosity)
+    geometry = station_geometry(con, verbosity)
 
 boromap = {
     'Manhattan below 63 St': 1,
@@ -907,16 +1313,11 @@ app = Dash(__name__, external_stylesheets=[dbc.themes.SANDSTONE])
 app.title = "Druce's MTA Dashboard"
 
 app.layout = html.Div(generate_content(), id='div_toplevel')
+# WSGI entry point, e.g. gunicorn --workers 4 --threads 4 --bind 0.0.0.0:8050 app:server
+server = app.server
 
 
-@app.callback(Output('text_panel_1', 'children'),
-              Output('text_panel_2', 'children'),
-              Output('text_panel_3', 'children'),
-              Output('fig1', 'children'),
-              Output('fig2', 'children'),
-              Output('fig3', 'children'),
-              Output('fig_table_parent', 'children'),
-              Output('fig_map_parent', 'children'),
+@app.callback(Output('filters', 'data'),
               Input('submit-button-state', 'n_clicks'),
               State('start-date-picker-single', 'date'),
               State('end-date-picker-single', 'date'),
@@ -924,9 +1325,8 @@ app.layout = html.Div(generate_content(), id='div_toplevel')
               State('checklist-dow', 'value'),
               State('checklist-tod', 'value'),
               State('dropdown-station', 'value'),
-              State('ma_value_input', 'value'),
               )
-def update_output(n_clicks, startdate, enddate, boro, dow, tod, sta, ma):
+def update_filters(n_clicks, startdate, enddate, boro, dow, tod, sta):
 
     filters = defaultdict(str)
 
@@ -957,40 +1357,79 @@ def update_output(n_clicks, startdate, enddate, boro, dow, tod, sta, ma):
         filters['sta'] = sta
 
     print(filters)
+    return filters
 
-    print(create_filter_current(con, filters, verbose=verbosity))
-    print(create_filter_pandemic(con, filters, verbose=verbosity))
-    print(create_filter_2019(con, filters, verbose=verbosity))
-
-    print(create_filter_current_daily(con, verbose=verbosity))
-    print(create_filter_pandemic_daily(con, verbose=verbosity))
-    print(create_filter_2019_daily(con, verbose=verbosity))
-
-    print(create_filter_current_summary(con, verbose=verbosity))
-    print(create_filter_pandemic_summary(con, verbose=verbosity))
-    print(create_filter_2019_summary(con, verbose=verbosity))
 
-    avg_entries_daily = query_value(con, "select avg(entries) from filter_current_summary", verbose=verbosity)
-    avg_entries_pandemic = query_value(con, "select avg(entries) from filter_pandemic_summary", verbose=verbosity)
-    avg_entries_2019 = query_value(con, "select avg(entries) from filter_2019_summary", verbose=verbosity)
+def panel_results(filters, names):
+    """results names for the filters store's data, on a connection of the panel's own"""
+    if not filters:
+        raise PreventUpdate
+    engine, generation = database.current(verbose=verbosity)
+    with engine.connect() as con:
+        return cached_results(con, generation, defaultdict(str, filters), names, verbose=verbosity)
 
-    df_entries_by_date = entries_by_date(con, verbose=verbosity)
-    df_entries_by_tod = entries_by_tod(con, verbose=verbosity)
-    df_entries_by_dow = entries_by_dow(con, verbose=verbosity)
-    df_entries_by_station = entries_by_station(con, verbose=verbosity)
 
-    # output_state = u'''
-    #     You have selected "{}" to "{}", borough "{}", DOW "{}", TOD"{}",
-    # '''.format(startdate, enddate, borough, dow, tod)
+# each panel has its own callback so cheap panels paint before the slow ones finish
+@app.callback(Output('text_panel_1', 'children'),
+              Output('text_panel_2', 'children'),
+              Output('text_panel_3', 'children'),
+              Input('filters', 'data'),
+              )
+def update_text_panels(filters):
+    avg = panel_results(filters, ['avg'])['avg']
+    avg_entries_daily = avg['entries_selection']
+    avg_entries_pandemic = avg['entries_pandemic']
+    avg_entries_2019 = avg['entries_2019']
     return [
         text_panel_1(avg_entries_daily, avg_entries_pandemic, avg_entries_2019),
         text_panel_2(avg_entries_pandemic, avg_entries_2019),
         text_panel_3(avg_entries_2019),
-        fig1(df_entries_by_date, ma),
-        fig2(df_entries_by_dow),
-        fig3(df_entries_by_tod),
-        [fig_table(df_entries_by_station), html.Div(id='datatable-interactivity-container')],
-        ["Station map, size=entries, color=%ch from 2019", fig_map(df_entries_by_station, mapbox_token),],
+    ]
+
+
+@app.callback(Output('by_date', 'data'),
+              Input('filters', 'data'),
+              )
+def update_by_date(filters):
+    df = panel_results(filters, ['by_date'])['by_date']
+    return {
+        'date': df['date'].astype(str).tolist(),
+        'entries': df['entries'].tolist(),
+        'exits': df['exits'].tolist(),
+    }
+
+
+# redraws the moving averages whenever the data or the MA window changes, in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='mta', function_name='moving_average'),
+    Output('entries-graph', 'figure'),
+    Input('by_date', 'data'),
+    Input('ma_value_input', 'value'),
+    State('entries-graph', 'figure'),
+)
+
+
+@app.callback(Output('fig2', 'children'),
+              Output('fig3', 'children'),
+              Input('filters', 'data'),
+              )
+def update_fig2_fig3(filters):
+    results = panel_results(filters, ['by_dow', 'by_tod'])
+    return [
+        fig2(results['by_dow']),
+        fig3(results['by_tod']),
+    ]
+
+
+@app.callback(Output('fig_table', 'data'),
+              Output('fig_map', 'figure'),
+              Input('filters', 'data'),
+              )
+def update_stations(filters):
+    df = station_changes(panel_results(filters, ['by_station'])['by_station'])
+    return [
+        table_data(df),
+        map_patch(geometry, df),
     ]
 
 # check e.g. q line this year
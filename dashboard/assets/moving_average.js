@@ -0,0 +1,42 @@
+// moving averages for the entries and exits by date chart (fig1 in app.py),
+// computed in the browser from the by_date store so a new MA window needs no server round trip
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    mta: {
+        moving_average: function(by_date, ma_interval, figure) {
+            if (!by_date || !figure) {
+                return window.dash_clientside.no_update;
+            }
+            var n = parseInt(ma_interval, 10);
+            if (isNaN(n) || n < 1) {
+                n = 1;
+            }
+
+            // same as pandas rolling(n).mean(), null until there are n values
+            function rolling(values) {
+                var out = new Array(values.length);
+                var sum = 0;
+                for (var i = 0; i < values.length; i++) {
+                    sum += values[i];
+                    if (i >= n) {
+                        sum -= values[i - n];
+                    }
+                    out[i] = i >= n - 1 ? sum / n : null;
+                }
+                return out;
+            }
+
+            var series = [['Entries', by_date.entries], ['Exits', by_date.exits]];
+            var data = series.map(function(s, i) {
+                var name = s[0] + ' (' + n + '-day MA) ';
+                return Object.assign({}, figure.data[i], {
+                    x: by_date.date,
+                    y: rolling(s[1]),
+                    name: name,
+                    hovertemplate: 'variable=' + name + '<br>date=%{x}<br>value=%{y}<extra></extra>'
+                });
+            });
+            return Object.assign({}, figure, {data: data});
+        }
+    }
+});
@@ -4,3 +4,5 @@
 source .env
 
 python app.py
+# or threaded, with several worker processes
+# gunicorn --workers 4 --threads 4 --bind 0.0.0.0:8050 app:server
@@ -0,0 +1,88 @@
+{#
+    Incremental runs reprocess from the first day of any ingested file the last complete build didn't
+    transform, i.e. new or changed files, including a late download of an earlier week. transformed_files
+    lists the ledger's files as of that build, it is rebuilt after the incremental models so a failed run
+    leaves it as it was. Each model deletes its rows from that day on in a pre_hook, then appends everything
+    after what remains, so the result matches a full refresh. mta_staging upserts the same days on its
+    unique key instead of deleting. Use dbt run --full-refresh after changing a seed.
+    An empty model (e.g. its rows deleted by hand) reprocesses from the first day of every file.
+    A database built before transformed_files existed reprocesses from the first day of any file
+    ending after what the model holds.
+#}
+{% macro reprocess_from(relation, column='date_time') %}
+    {%- set transformed_files = adapter.get_relation(database=relation.database, schema=relation.schema,
+                                                     identifier='transformed_files') -%}
+    (select min(ledger.MIN_DATE)
+     from {{ source('mta', 'ingest_ledger') }} ledger
+     where (select max({{ column }}) from {{ relation }}) is null
+     {% if transformed_files is not none %}
+        or not exists (select 1 from {{ transformed_files }} transformed
+                       where transformed.filename = ledger.FILENAME and transformed.sha256 = ledger.SHA256))
+     {% else %}
+        or ledger.MAX_DATE > (select max({{ column }})::date from {{ relation }}))
+     {% endif %}
+{% endmacro %}
+
+{#
+    Fail when days mta_staging just reprocessed have readings at or before their turnstile's last differenced
+    reading in state, e.g. from a late download of an earlier week or a changed file: mta_diff only differences
+    each turnstile's readings after its state, so they would change differences already taken.
+#}
+{% macro check_backdated(staging, state) %}
+    {% if execute %}
+        {% set query %}
+            select count(*), min(staging.date_time)
+            from {{ staging }} staging
+                join {{ state }} state on state.turnstile_id = staging.turnstile_id
+            where staging.date_time >= {{ reprocess_from(staging) }}
+                and staging.date_time <= state.date_time
+        {% endset %}
+        {% set row = run_query(query).rows[0] %}
+        {% if row[0] > 0 %}
+            {{ exceptions.raise_compiler_error("%d readings from %s in %s are at or before their turnstile's last differenced reading, e.g. from a late download of an earlier week or a changed file. Run dbt run --full-refresh to difference every reading again" % (row[0], row[1], staging)) }}
+        {% endif %}
+    {% endif %}
+{% endmacro %}
+
+{#
+    upsert: insert the new rows, a row whose unique_key is already in the table replaces it if the
+    model's upsert_when holds (excluded is the new row, staged the one in the table), or always without
+    one, and logs how many did. The table needs a unique index on the key, see mta_staging. DuckDB rejects
+    reinserting a key deleted earlier in the same transaction, so this stands in for a pre_hook delete
+    followed by append.
+#}
+{% macro get_incremental_upsert_sql(arg_dict) %}
+    {%- set dest_cols = arg_dict["dest_columns"] | map(attribute="name") | list -%}
+    {%- set dest_cols_csv = get_quoted_csv(dest_cols) -%}
+    {%- set unique_key = arg_dict["unique_key"] -%}
+    {%- set key = [unique_key] if unique_key is string else unique_key -%}
+    {%- set key_lower = key | map("lower") | list -%}
+    {%- set upsert_when = config.get("upsert_when") -%}
+    {%- set updates = [] -%}
+    {%- for col in dest_cols if col | lower not in key_lower -%}
+        {%- do updates.append(adapter.quote(col) ~ " = excluded." ~ adapter.quote(col)) -%}
+    {%- endfor -%}
+    {% if execute %}
+        {% set query %}
+            select count(*)
+            from {{ arg_dict["temp_relation"] }} excluded
+                join {{ arg_dict["target_relation"] }} staged
+                    on {% for col in key %}staged.{{ col }} = excluded.{{ col }}{{ " and " if not loop.last }}{% endfor %}
+            {% if upsert_when %}where {{ upsert_when }}{% endif %}
+        {% endset %}
+        {{ log("%s: replacing %d rows" % (arg_dict["target_relation"], run_query(query).rows[0][0]), info=True) }}
+    {% endif %}
+    insert into {{ arg_dict["target_relation"] }} as staged ({{ dest_cols_csv }})
+    select {{ dest_cols_csv }} from {{ arg_dict["temp_relation"] }}
+    on conflict ({{ key | join(", ") }}) do update set {{ updates | join(", ") }}
+    {% if upsert_when %}where {{ upsert_when }}{% endif %}
+{% endmacro %}
+
+{# log how many duplicate raw rows the readings in relation collapsed #}
+{% macro report_duplicates(relation) %}
+    {% if execute %}
+        {% set result = run_query("select count(*), coalesce(sum(readings), 0) - count(*), count(*) filter (where readings > 1) from " ~ relation) %}
+        {% set row = result.rows[0] %}
+        {{ log("%s: %d readings, dropped %d duplicate raw rows from %d of them" % (relation, row[0], row[1], row[2]), info=True) }}
+    {% endif %}
+{% endmacro %}
@@ -0,0 +1,13 @@
+{#
+    DuckDB settings for dbt from DUCKDB_DBT_<SETTING>, else DUCKDB_<SETTING>, see mta_resources.py.
+    Runs on-run-start, set global applies them to every thread's cursor. Unset settings keep DuckDB's
+    defaults, the hook is empty when none are set.
+#}
+{% macro duckdb_settings(workload='dbt') %}
+    {%- for name in ['memory_limit', 'threads', 'temp_directory', 'preserve_insertion_order'] -%}
+        {%- set value = env_var('DUCKDB_' ~ workload | upper ~ '_' ~ name | upper, env_var('DUCKDB_' ~ name | upper, '')) -%}
+        {%- if value %}
+    set global {{ name }} = '{{ value }}';
+        {%- endif -%}
+    {%- endfor -%}
+{% endmacro %}
@@ -0,0 +1,9 @@
+-- stamped once per build, after the tables the dashboard reads
+-- the dashboard clears its result cache when generation changes
+-- depends_on: {{ ref('station_list') }}
+-- depends_on: {{ ref('rollup_hourly') }}
+-- depends_on: {{ ref('rollup_daily') }}
+-- depends_on: {{ ref('rollup_baseline') }}
+select
+    '{{ invocation_id }}' generation,
+    current_timestamp built_at
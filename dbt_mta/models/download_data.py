@@ -1,8 +1,7 @@
-from datetime import date, timedelta
+from datetime import date
 from time import strftime
-from pathlib import Path
 import os
-import subprocess
+import sys
 import pandas as pd
 from dotenv import load_dotenv
 
@@ -24,37 +23,27 @@ def model(dbt, session):
         exit(1)
     DOWNLOADDIR = os.getenv('DATADIR')
     DATADIR = "%s/%s" % (BASEDIR, DOWNLOADDIR)
-    PREFIX = "http://web.mta.info/developers/data/nyct/turnstile/turnstile_"
-    SUFFIX = ".txt"
     START_DATE = date(2019, 1, 1)
     END_DATE = date.today()
 
     os.chdir(BASEDIR)
+    # shared download engine lives in BASEDIR
+    sys.path.insert(0, BASEDIR)
+    from mta_download import download_files, file_info
+    from mta_lake import convert_to_lake
+    from mta_resources import connect
 
-    delta = END_DATE - START_DATE   # returns timedelta
-    alldays = [START_DATE + timedelta(days=i) for i in range(delta.days + 1)]
-    alldays = [day for day in alldays if day.weekday() == 5]
-
-    count = 0
-    for d in alldays:
-        infix = strftime("%y%m%d", d.timetuple())
-        url = "%s%s%s" % (PREFIX, infix, SUFFIX)
-        src = "%s/%s%s" % (DATADIR, infix, SUFFIX)
-
-        if Path(src).is_file():
-            continue
-
-        cmd = "curl %s > %s" % (url, src)
-        print("%s - %s" % (strftime("%H:%M:%S"), cmd))
-        os.system(cmd)
-        count += 1
+    count, manifest = download_files(DATADIR, START_DATE, END_DATE)
 
     print("%s - %d files downloaded" % (strftime("%H:%M:%S"), count))
     datafiles = sorted([DATADIR + "/" + f for f in os.listdir(DATADIR) if f[-4:] == ".txt"])
-    result = subprocess.run(['wc', '-l', ] + datafiles, stdout=subprocess.PIPE)
-    lastresult = result.stdout.splitlines()[-1]
-    # total lines - number of header rows
-    expected = int(lastresult.split()[0]) - len(datafiles)
+    # row counts are recorded in the manifest as files are downloaded, no need to re-read them
+    expected = sum([manifest[os.path.basename(f)].get('rows', 0) for f in datafiles if os.path.basename(f) in manifest])
+
+    # parse each new file once into the Parquet lake
+    LAKEDIR = "%s/%s" % (BASEDIR, os.getenv('LAKEDIR', 'lake'))
+    convert_to_lake(connect(":memory:", "ingest"), file_info(datafiles, DATADIR), LAKEDIR)
+
     final_df = pd.DataFrame({'rows': [expected]})
     print("%s - %d files, %d rows in %s " % (strftime("%H:%M:%S"), len(datafiles), expected, DATADIR))
     print("%s - Finished download" % (strftime("%H:%M:%S")))
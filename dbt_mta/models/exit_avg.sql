@@ -1,20 +1,23 @@
 -- not used, could drop rows based on > 4 standard deviations from mean or 2000, whichever is greater
-select 
-    station, 
-    turnstile, 
-    avg(exits) mean, 
-    stddev(exits) sd, 
-    count(*) n, 
-    avg(exits)+4*stddev(exits) exits_cutoff 
-from {{ref('mta_diff')}}
-where exits > 0
-group by station, turnstile
-
-{{ config(
-    post_hook = "
-        update exit_avg set exits_cutoff = 2000 where N <= 20;
-        update exit_avg set exits_cutoff = 2000 where isnan(exits_cutoff);
-        update exit_avg set exits_cutoff = 2000 where exits_cutoff < 2000;
-    "
-) }}
-
+-- derived from the running moments in turnstile_moments, 2000 where n <= 20
+with moments as
+    (select
+        station_id,
+        turnstile_id,
+        mean,
+        case when n > 1 then sqrt(m2 / (n - 1)) end sd,
+        n
+    from {{ref('turnstile_moments')}}
+    where direction = 'exits'
+    )
+select
+    station_id,
+    turnstile_id,
+    mean,
+    sd,
+    n,
+    case
+        when n <= 20 or isnan(mean + 4 * sd) then 2000
+        else greatest(mean + 4 * sd, 2000)
+    end exits_cutoff
+from moments
@@ -1,7 +1,7 @@
 # load data from downloads into mta.mta_raw table
 from time import strftime
 import os
-import subprocess
+import sys
 
 import pandas as pd
 import duckdb
@@ -14,7 +14,12 @@ CURRENTFILE = os.path.basename(__file__)
 DOWNLOADDIR = os.getenv('DATADIR')
 DATADIR = "%s/%s" % (BASEDIR, DOWNLOADDIR)
 DBFILE = os.getenv('DBFILE')
+LAKEDIR = "%s/%s" % (BASEDIR, os.getenv('LAKEDIR', 'lake'))
+# the same database as dbt's connection, so the dbt DuckDB settings apply (macros/resources.sql)
 con = duckdb.connect("%s/%s" % (BASEDIR, DBFILE))
+# shared ingest engine lives in BASEDIR
+sys.path.insert(0, BASEDIR)
+from mta_ingest import ingest, verify  # noqa: E402
 
 
 def model(dbt, session):
@@ -36,61 +41,23 @@ def model(dbt, session):
 
     log("Starting data ingestion in %s" % os.getcwd())
     log("Ingesting from %s into %s/%s" % (DATADIR, BASEDIR, DBFILE))
-    log("Creating mta.mta_raw table")
-
     query = """CREATE SCHEMA IF NOT EXISTS mta"""
     run_sql(query)
 
-    query = """
-    create or replace table mta.mta_raw(
-        "C/A" VARCHAR,
-        UNIT VARCHAR,
-        SCP VARCHAR,
-        STATION VARCHAR,
-        LINENAME VARCHAR,
-        DIVISION VARCHAR,
-        DATE DATE,
-        TIME TIME,
-        "DESC" VARCHAR,
-        ENTRY_COUNTER INTEGER,
-        EXIT_COUNTER INTEGER);
-    """
-    run_sql(query)
-
     datafiles = sorted([DATADIR + "/" + f for f in os.listdir(DATADIR) if f[-4:] == ".txt"])
 
     log("Found %d files in %s/%s" % (len(datafiles), os.getcwd(), DATADIR))
 
-    query = """
-    insert into mta.mta_raw SELECT * FROM read_csv('%s', \
-                                                    delim=',', \
-                                                    header=True, \
-                                                    columns={'C/A': 'VARCHAR', \
-                                                            'UNIT': 'VARCHAR', \
-                                                            'SCP': 'VARCHAR', \
-                                                            'STATION': 'VARCHAR', \
-                                                            'LINENAME': 'VARCHAR', \
-                                                            'DIVISION': 'VARCHAR', \
-                                                            'DATE': 'DATE', \
-                                                            'TIME': 'TIME',\
-                                                            'DESC': 'VARCHAR',\
-                                                            'ENTRIES': 'INTEGER',\
-                                                            'EXITS': 'INTEGER',},\
-                                                        dateformat='%%m/%%d/%%Y');
-    """
-
-    for f in datafiles:
-        log("Ingesting %s" % f)
-        run_sql(query % f)
+    # FULL_REFRESH=1 drops mta.mta_raw and reloads every file, THREADS sets DuckDB parallelism
+    threads = int(os.getenv('THREADS')) if os.getenv('THREADS') else None
+    ingest(con, datafiles, DATADIR, schema="mta", full_refresh=bool(os.getenv('FULL_REFRESH')), threads=threads,
+           lakedir=LAKEDIR)
 
     log("Verifying row count")
-    result = subprocess.run(['wc', '-l', ] + datafiles, stdout=subprocess.PIPE)
-    lastresult = result.stdout.splitlines()[-1]
-    # total lines - number of header rows
-    expected = int(lastresult.split()[0]) - len(datafiles)
-    log("Expected %d rows from 'wc'" % expected)
+    mismatches = verify(con, schema="mta")
+    if mismatches:
+        log("%d files did not load completely" % len(mismatches))
     result = run_sql('select count(*) from mta.mta_raw')
-    log("Ingested %d rows into mta.mta_raw" % result[0][0])
     log("Ended data ingestion from %s/%s" % (BASEDIR, DATADIR))
 
     final_df = pd.DataFrame({'rows': [result[0][0]]})
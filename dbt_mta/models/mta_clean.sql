@@ -1,32 +1,65 @@
+with diff as
+    (select
+        -- split into date and integer hour
+        date_trunc('day', date_time)::date as date,
+        -- round hour = minutes/60 to nearest multiple of 4
+        4 * round((date_part('hour', date_time)::float + date_part('minute', date_time)::float/60) / 4) as hour,
+        station_id,
+        entries,
+        exits
+    from
+        {{ref('mta_diff')}}
+    {% if is_incremental() %}
+    -- pre_hook deleted the days being reprocessed, rows from the day after what is left
+    -- (midnight readings count toward the previous day)
+    where (select max(date) from {{ this }}) is null or date_time >= (select max(date) + 1 from {{ this }})
+    {% endif %}
+    ),
+shifted as
+    (select
+        -- move midnight to prev day, hour=24
+        case when hour = 0 then date - 1 else date end as date,
+        case when hour = 0 then 24 else hour end as hour,
+        station_id,
+        entries,
+        exits
+    from diff
+    )
 select
-    -- split into date and integer hour
-    date_trunc('day', date_time) date,
-    -- round hour = minutes/60 to nearest multiple of 4
-    4 * round((date_part('hour', date_time)::float + date_part('minute', date_time)::float/60) / 4)  as hour,
+    date,
+    hour::integer as hour,
     -- pretty name, borough from station_list
     map.pretty_name station,
     map.borough boro,
-    sum(entries) entries,
-    sum(exits) exits
+    sum(entries)::integer entries,
+    sum(exits)::integer exits
 from
-    {{ref('mta_diff')}} mta_diff
-    left outer join {{ref('station_list')}} map on mta_diff.station=map.station
-group by 
+    shifted
+    left outer join {{ref('station_list')}} map on shifted.station_id=map.station_id
+where
+    date_part('year', date) >= 2019
+    {% if is_incremental() %}
+    and ((select max(date) from {{ this }}) is null or date > (select max(date) from {{ this }}))
+    {% endif %}
+group by
     date,
     hour,
     map.pretty_name,
     boro
 -- drop periods with no exits or entries
-having sum(mta_diff.entries) > 0 or sum(mta_diff.exits) > 0
+having sum(shifted.entries) > 0 or sum(shifted.exits) > 0
+-- written sorted so row group zone maps prune date and station filters, see mta_pruning.py.
+-- Incremental runs only append dates after what is left, so the table stays sorted
+order by
+    date,
+    station
 
 {{ config(
-  post_hook = "
-    alter table mta_clean alter hour type integer;
-    alter table mta_clean alter entries type integer;
-    alter table mta_clean alter exits type integer;
-    -- move midnight to prev day, hour=24
-    update mta_clean set hour=24, date=date-1 where hour = 0;
-    delete from mta_clean where date_part('year', date)<2019;
+  pre_hook = "
+    {% if is_incremental() %}
+    -- a day's 24:00 bucket includes the next day's midnight readings, reprocess the day before too
+    delete from {{ this }} where date >= {{ reprocess_from(this, 'date') }} - 1;
+    {% endif %}
 ") }}
 
 {# ignore this
@@ -40,4 +73,4 @@ having sum(mta_diff.entries) > 0 or sum(mta_diff.exits) > 0
     alter table mta_clean alter entries type integer;
     alter table mta_clean alter exits type integer;
 ") }}
-#}
\ No newline at end of file
+#}
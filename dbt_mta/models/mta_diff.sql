@@ -1,20 +1,56 @@
 -- coompute abs diffs from mta_staging, drop anomalous entries or exits that are prob maintenance
-with subquery as 
+{% set turnstile_state = adapter.get_relation(database=this.database, schema=this.schema, identifier='turnstile_state') %}
+{% if is_incremental() and turnstile_state is not none %}
+{{ check_backdated(ref('mta_staging'), turnstile_state) }}
+{% endif %}
+with
+{% if is_incremental() %}
+-- each turnstile's last reading as of the previous run, carried forward so only new rows are windowed
+-- (turnstile_state is built after this model, so it isn't a ref)
+state as
+    (
+    {% if turnstile_state is not none %}
+    select turnstile_id, station_id, date_time, entry_counter, exit_counter from {{ turnstile_state }}
+    {% else %}
+    -- no turnstile_state yet: each turnstile's last reading as of what is already differenced
+    select turnstile_id, station_id, date_time, entry_counter, exit_counter
+    from {{ref('mta_staging')}}
+    where date_time <= (select max(date_time) from {{ this }})
+    qualify row_number() over (partition by turnstile_id order by date_time desc) = 1
+    {% endif %}
+    ),
+staging as
+    (select turnstile_id, station_id, date_time, entry_counter, exit_counter, true carried from state
+    union all
+    select staging.turnstile_id, staging.station_id, staging.date_time, staging.entry_counter, staging.exit_counter,
+        false carried
+    from {{ref('mta_staging')}} staging
+        left outer join state on state.turnstile_id = staging.turnstile_id
+    -- each turnstile's readings after its state, every reading of a turnstile with none (or an empty model)
+    where state.date_time is null or staging.date_time > state.date_time
+    ),
+{% else %}
+staging as
+    (select *, false carried from {{ref('mta_staging')}}),
+{% endif %}
+subquery as 
     (SELECT 
-        date_time, 
-        station, 
-        turnstile,
+        date_time,
+        station_id,
+        turnstile_id,
         entry_counter,
         abs(entry_counter - LAG(entry_counter) OVER w) AS entries,
         exit_counter,
         abs(exit_counter - LAG(exit_counter) OVER w) AS exits,
         date_diff('second', LAG(date_time) OVER w, date_time) as seconds_diff,
         date_part('day', date_time - lag(date_time) over w) * 24 +
-            date_part('hour', date_time - lag(date_time) over w) as hours_difference
-    FROM {{ref('mta_staging')}}
-    WINDOW w AS (PARTITION BY station, turnstile ORDER BY date_time)
+            date_part('hour', date_time - lag(date_time) over w) as hours_difference,
+        carried
+    FROM staging
+    -- turnstile_id stands for (station, turnstile), an integer partition key sorts much faster than the names
+    WINDOW w AS (PARTITION BY turnstile_id ORDER BY date_time)
     )
-select * from subquery
+select * exclude (carried) from subquery
     -- drop rows where we are seeing negative numbers or more than 1 click per second
     where 
     seconds_diff < 345600  -- after 24h, not attributing to correct date, clearly maintenance was performed
@@ -26,6 +62,8 @@ select * from subquery
     -- sometimes a report is skipped, one row picks up multiple periods
     -- but at some point you're recording a lot of data in the wrong period or day even if real
     -- maybe less problematic to drop a row than to move many legit entries to wrong period
+    -- only the new rows, not the carried-forward state
+    and not carried
 
 
 {# ignore this
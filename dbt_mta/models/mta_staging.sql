@@ -1,36 +1,51 @@
--- move from mta_raw to mta_staging
-select distinct
-    make_timestamp(date_part('year', DATE),
-        date_part('month', DATE),
-        date_part('day', DATE),
-        date_part('hour', TIME),
-        date_part('minute', TIME),
-        date_part('second', TIME)) DATE_TIME,
-    CONCAT("C/A" , ' ' , UNIT , ' ' , SCP) TURNSTILE,
-    CONCAT(
-        COALESCE(slo.STATION_DEST, CONCAT(STATION, '-', LINENAME)), 
-        COALESCE(dlo.division_dest, '')
-        ) STATION,
-    ENTRY_COUNTER,
-    EXIT_COUNTER
-from 
-    {{ source('mta', 'mta_raw') }} mta_raw
-    -- might be more consistent to just use the complex
-    -- first cut I didn't have complex, merged stations that needed merging using station_level_override
-    -- for some complexes like 624 cortlandt/chambers/park place/wtc, 53/51st information is lost
-    -- I usually merged less if no ambiguity
-    left outer join {{ref('station_label_override')}} slo on slo.station_src = CONCAT(STATION, '-', LINENAME)
-    -- just wanted more legible station ID
-    left outer join {{ref('division_label_override')}} dlo on dlo.division_src = division
-    -- where "DESC" <> 'RECOVR AUD'
-    -- skip staten island, only 2 stations reflected in CSVs for some reason
-where
-    division not in ('SRT')
-    -- skip NJ PATH stations but keep NYC - added J as borough in station_map
-    and mta_raw.station not in ('CITY / BUS','EXCHANGE PLACE','GROVE STREET','HARRISON','JOURNAL SQUARE','LACKAWANNA','NEWARK BM BW','NEWARK C','NEWARK HM HE','NEWARK HW BMEBE','PAVONIA/NEWPORT')
-    -- start 1/1/2019
-    and date_part('year', DATE) > 2018
+-- move from mta_raw to mta_staging, names replaced by turnstile_dim's integer ids
+-- one row per reading, keyed on (turnstile_id, date_time), readings is the number of raw rows it stands for.
+-- Of conflicting rows for a key, a regular reading wins over a recovered audit (RECOVR AUD),
+-- then the highest entry counter, then the highest exit counter. A staged reading is replaced by a conflicting
+-- one from a later run only if its counters are higher (upsert_when), as 2-transform_data.py does.
+with readings as
+    (select
+        make_timestamp(date_part('year', DATE),
+            date_part('month', DATE),
+            date_part('day', DATE),
+            date_part('hour', TIME),
+            date_part('minute', TIME),
+            date_part('second', TIME)) DATE_TIME,
+        dim.TURNSTILE_ID,
+        dim.STATION_ID,
+        -- structs compare field by field, max picks the winning reading
+        {'regular': "DESC" is distinct from 'RECOVR AUD',
+         'entry_counter': ENTRY_COUNTER,
+         'exit_counter': EXIT_COUNTER} reading
+    from
+        {{ref('mta_labeled')}} labeled
+        join {{ref('turnstile_dim')}} dim on dim.turnstile = labeled.turnstile and dim.station = labeled.station
+    {% if is_incremental() %}
+    -- upsert the days being reprocessed, readings already staged are replaced, new ones appended
+    where DATE >= {{ reprocess_from(this) }}
+    {% endif %}
+    )
+select
+    DATE_TIME,
+    TURNSTILE_ID,
+    STATION_ID,
+    max(reading).entry_counter ENTRY_COUNTER,
+    max(reading).exit_counter EXIT_COUNTER,
+    count(*) READINGS
+from readings
+group by
+    DATE_TIME,
+    TURNSTILE_ID,
+    STATION_ID
 
 -- check a week with no recovr aud or weirdness, match exactly
 -- clone repo, grep recovr aud
 -- find logic with the dropping records, dupe exactly
+
+{{ config(
+    upsert_when = "{'entry_counter': excluded.entry_counter, 'exit_counter': excluded.exit_counter}
+        > {'entry_counter': staged.entry_counter, 'exit_counter': staged.exit_counter}",
+    post_hook = "
+        create unique index if not exists mta_staging_key on {{ this }} (turnstile_id, date_time);
+        {{ report_duplicates(this) }}
+") }}
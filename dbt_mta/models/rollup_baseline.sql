@@ -0,0 +1,31 @@
+-- 2019 and pandemic baselines by day of week, hour and station
+-- days is the number of dates summed, so an average day is sum(entries) / days
+-- weeks has a bit set for each date summed, bit n for the period's week n (a period's dates of one dow are in
+-- different weeks), the dates of several rows of a dow are bit_count of their weeks or'ed together
+with periods as (
+    select '2019' period, date '2019-01-01' startdate, date '2020-01-01' enddate
+    union all
+    select 'Pandemic' period, date '2020-04-01' startdate, date '2021-04-01' enddate
+)
+select
+    period,
+    dow,
+    hour,
+    station,
+    boro,
+    count(*) as days,
+    bit_or(1::bigint << ((hourly.date - periods.startdate) // 7)) as weeks,
+    sum(entries)::bigint entries,
+    sum(exits)::bigint exits
+from
+    {{ref('rollup_hourly')}} hourly
+    join periods on hourly.date >= periods.startdate and hourly.date < periods.enddate
+group by
+    period,
+    dow,
+    hour,
+    station,
+    boro
+order by
+    period,
+    station
@@ -0,0 +1,18 @@
+-- daily totals by station, answers dashboard queries without a time of day filter
+select
+    date,
+    dow,
+    station,
+    boro,
+    sum(entries)::integer entries,
+    sum(exits)::integer exits
+from
+    {{ref('rollup_hourly')}}
+group by
+    date,
+    dow,
+    station,
+    boro
+order by
+    date,
+    station
@@ -0,0 +1,14 @@
+-- mta_clean at the grain the dashboard filters on: date, dow, hour, station, boro
+select
+    date,
+    datepart('dow', date)::integer dow,
+    hour,
+    station,
+    boro,
+    entries,
+    exits
+from
+    {{ref('mta_clean')}}
+order by
+    date,
+    station
@@ -0,0 +1,21 @@
+-- dense integer id for each station name, mta_staging and everything after it carry station_id
+-- ids are only ever appended (full_refresh: false), so they stay the same across runs
+-- mta_staging is built after this model and read only for the days it will reprocess, so it isn't a ref
+{% set staging = adapter.get_relation(database=this.database, schema=this.schema, identifier='mta_staging') %}
+with stations as
+    (select distinct station
+    from {{ref('mta_labeled')}}
+    {% if is_incremental() and staging is not none %}
+    where DATE >= {{ reprocess_from(staging) }}
+    {% endif %}
+    )
+select
+    {% if is_incremental() %}
+    (select coalesce(max(station_id), 0) from {{ this }}) +
+    {% endif %}
+    row_number() over (order by stations.station)::integer station_id,
+    stations.station
+from stations
+{% if is_incremental() %}
+where stations.station not in (select station from {{ this }})
+{% endif %}
@@ -1,8 +1,11 @@
 with stations as (
- select distinct station from {{ref('mta_diff')}}
+ select station_dim.station_id, station_dim.station
+ from {{ref('station_dim')}} station_dim
+ where station_dim.station_id in (select distinct station_id from {{ref('mta_diff')}})
  order by station
 )
 select
+    stations.station_id,
     stations.station,
     concat(map.stop_name, '-', map.daytime_routes, ' (', map.borough, ')') pretty_name,
     latitude,
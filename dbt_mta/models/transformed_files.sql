@@ -0,0 +1,12 @@
+-- ingest_ledger's files as of this build, built after the incremental models (skipped if one fails),
+-- so the next run reprocesses from the first day of any file not listed here, see reprocess_from
+-- depends_on: {{ ref('mta_staging') }}
+-- depends_on: {{ ref('turnstile_state') }}
+-- depends_on: {{ ref('turnstile_moments') }}
+-- depends_on: {{ ref('mta_clean') }}
+select
+    FILENAME filename,
+    SHA256 sha256,
+    MIN_DATE min_date,
+    MAX_DATE max_date
+from {{ source('mta', 'ingest_ledger') }}
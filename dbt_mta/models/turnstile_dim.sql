@@ -0,0 +1,27 @@
+-- dense integer id for each turnstile at a station, mta_diff windows on turnstile_id
+-- a turnstile whose readings move to another station name gets a new id, as its (station, turnstile) window did
+-- ids are only ever appended (full_refresh: false), so they stay the same across runs
+-- mta_staging is built after this model and read only for the days it will reprocess, so it isn't a ref
+{% set staging = adapter.get_relation(database=this.database, schema=this.schema, identifier='mta_staging') %}
+with turnstiles as
+    (select distinct labeled.turnstile, labeled.station, station_dim.station_id
+    from {{ref('mta_labeled')}} labeled
+        join {{ref('station_dim')}} station_dim on station_dim.station = labeled.station
+    {% if is_incremental() and staging is not none %}
+    where labeled.DATE >= {{ reprocess_from(staging) }}
+    {% endif %}
+    )
+select
+    {% if is_incremental() %}
+    (select coalesce(max(turnstile_id), 0) from {{ this }}) +
+    {% endif %}
+    row_number() over (order by turnstiles.station_id, turnstiles.turnstile)::integer turnstile_id,
+    turnstiles.turnstile,
+    turnstiles.station,
+    turnstiles.station_id
+from turnstiles
+{% if is_incremental() %}
+where not exists
+    (select 1 from {{ this }} dim
+    where dim.turnstile = turnstiles.turnstile and dim.station_id = turnstiles.station_id)
+{% endif %}
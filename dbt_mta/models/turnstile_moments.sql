@@ -0,0 +1,50 @@
+-- running count, mean and M2 (sum of squared deviations from the mean) of each turnstile's nonzero entries
+-- and exits, entry_avg and exit_avg derive means, SDs and cutoffs from it.
+-- Each run folds in only the mta_diff rows since the last one, merging their moments into the running ones
+-- (Chan et al.'s parallel form of Welford's algorithm), so the stats match a full recompute without one.
+-- mta_diff only appends a turnstile's rows later than any of its rows it holds,
+-- so each turnstile and direction's latest date_time folded in marks what is new.
+with diff as
+    (select turnstile_id, station_id, date_time, entries, exits
+    from {{ref('mta_diff')}}
+    ),
+batch as
+    (select
+        readings.turnstile_id,
+        readings.station_id,
+        readings.direction,
+        count(*) n,
+        avg(x) mean,
+        var_pop(x) * count(*) m2,
+        max(readings.date_time) date_time
+    from (
+        select turnstile_id, station_id, 'entries' direction, entries x, date_time from diff where entries > 0
+        union all
+        select turnstile_id, station_id, 'exits' direction, exits x, date_time from diff where exits > 0
+        ) readings
+    {% if is_incremental() %}
+        left outer join {{ this }} folded
+            on folded.turnstile_id = readings.turnstile_id and folded.direction = readings.direction
+    where folded.date_time is null or readings.date_time > folded.date_time
+    {% endif %}
+    group by
+        readings.turnstile_id,
+        readings.station_id,
+        readings.direction
+    )
+{% if is_incremental() %}
+-- merge with the running moments, delete+insert replaces the turnstiles in the batch
+select
+    batch.turnstile_id,
+    batch.station_id,
+    batch.direction,
+    coalesce(prev.n, 0) + batch.n n,
+    coalesce(prev.mean, 0) + (batch.mean - coalesce(prev.mean, 0)) * batch.n / (coalesce(prev.n, 0) + batch.n) mean,
+    coalesce(prev.m2, 0) + batch.m2
+        + (batch.mean - coalesce(prev.mean, 0)) ^ 2 * coalesce(prev.n, 0) * batch.n / (coalesce(prev.n, 0) + batch.n) m2,
+    batch.date_time
+from batch
+    left outer join {{ this }} prev on prev.turnstile_id = batch.turnstile_id and prev.direction = batch.direction
+{% else %}
+select * from batch
+{% endif %}
@@ -0,0 +1,17 @@
+-- last reading of each turnstile, carried forward so mta_diff only has to difference new rows
+-- depends_on: {{ ref('mta_diff') }}
+select
+    staging.turnstile_id,
+    staging.station_id,
+    max(staging.date_time) date_time,
+    arg_max(staging.entry_counter, staging.date_time) entry_counter,
+    arg_max(staging.exit_counter, staging.date_time) exit_counter
+from {{ref('mta_staging')}} staging
+{% if is_incremental() %}
+    left outer join {{ this }} state on state.turnstile_id = staging.turnstile_id
+-- each turnstile's readings after its state, as mta_diff differenced them, turnstiles with none keep their state
+where state.date_time is null or staging.date_time > state.date_time
+{% endif %}
+group by
+    staging.turnstile_id,
+    staging.station_id
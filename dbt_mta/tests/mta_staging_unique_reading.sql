@@ -0,0 +1,5 @@
+-- mta_staging has one row per (turnstile_id, date_time)
+select turnstile_id, date_time, count(*) n
+from {{ ref('mta_staging') }}
+group by turnstile_id, date_time
+having count(*) > 1
@@ -98,7 +98,7 @@ class SqlExtension(Extension):
 def sql_safe(value):
     """Filter to mark the value of an expression as safe for inserting
     in a SQL statement"""
-    return Markup(value)
+    return markupsafe.Markup(value)
 
 def bind(value, name):
     """A filter that prints %s, and stores the value 
@@ -0,0 +1,254 @@
+# parallel, resumable downloader for the weekly MTA turnstile files
+# used by 0-download_data.py and dbt_mta/models/download_data.py
+
+from datetime import timedelta
+from time import strftime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+PREFIX = "http://web.mta.info/developers/data/nyct/turnstile/turnstile_"
+SUFFIX = ".txt"
+MANIFEST = "manifest.json"
+WORKERS = 8
+CHUNKSIZE = 1024 * 1024
+TIMEOUT = 60
+
+_thread_local = threading.local()
+_manifest_lock = threading.Lock()
+
+
+def log(s):
+    print("%s - %s - %s" % (strftime("%H:%M:%S"), "mta_download", s))
+
+
+def get_session():
+    """one requests.Session per worker thread, so each worker reuses its own keep-alive connection"""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _thread_local.session = session
+    return session
+
+
+def saturdays(start_date, end_date):
+    """every Saturday from start_date to end_date inclusive, MTA publishes one file per week"""
+    delta = end_date - start_date
+    alldays = [start_date + timedelta(days=i) for i in range(delta.days + 1)]
+    return [day for day in alldays if day.weekday() == 5]
+
+
+def file_list(start_date, end_date, prefix=PREFIX, suffix=SUFFIX):
+    """list of (url, filename) for each weekly file"""
+    retval = []
+    for d in saturdays(start_date, end_date):
+        infix = strftime("%y%m%d", d.timetuple())
+        retval.append(("%s%s%s" % (prefix, infix, suffix), "%s%s" % (infix, suffix)))
+    return retval
+
+
+def load_manifest(downloaddir):
+    """manifest maps filename -> {url, size, etag, last_modified, sha256, rows, downloaded}"""
+    manifest_path = Path(downloaddir) / MANIFEST
+    if not manifest_path.is_file():
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(downloaddir, manifest):
+    """write manifest to a temp file and rename, so a crash never leaves a partial manifest"""
+    manifest_path = Path(downloaddir) / MANIFEST
+    tmp_path = manifest_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+class Digest:
+    """sha256 and CSV row count of a file, computed in the same pass over the bytes"""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.lines = 0
+        self.last = b"\n"
+
+    def update(self, chunk):
+        if chunk:
+            self.sha256.update(chunk)
+            self.lines += chunk.count(b"\n")
+            self.last = chunk[-1:]
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def rows(self):
+        """data rows, i.e. lines (counting an unterminated last line) minus the header"""
+        lines = self.lines + (0 if self.last == b"\n" else 1)
+        return max(lines - 1, 0)
+
+
+def file_digest(filename):
+    """(sha256, rows) of a local file"""
+    h = Digest()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNKSIZE), b""):
+            h.update(chunk)
+    return h.hexdigest(), h.rows()
+
+
+def file_info(datafiles, downloaddir):
+    """
+    {filename: (path, size, sha256, rows)} for each data file.
+    sha256 and rows come from the download manifest when the size matches, otherwise they're
+    computed in one pass over the file.
+    """
+    manifest = load_manifest(downloaddir)
+    retval = {}
+    for f in datafiles:
+        filename = Path(f).name
+        size = Path(f).stat().st_size
+        entry = manifest.get(filename)
+        if entry and entry["size"] == size and "rows" in entry:
+            sha256, rows = entry["sha256"], entry["rows"]
+        else:
+            sha256, rows = file_digest(f)
+        retval[filename] = (f, size, sha256, rows)
+    return retval
+
+
+def is_complete(url, dest, entry):
+    """
+    True if dest is a finished download.
+    Files recorded in the manifest must match the recorded size.
+    Files downloaded before the manifest existed (e.g. by curl) are checked against
+    Content-Length with a HEAD request, so a truncated file gets fetched again.
+    """
+    if not dest.is_file():
+        return False
+    size = dest.stat().st_size
+    if entry:
+        return entry["size"] == size
+    response = get_session().head(url, timeout=TIMEOUT, allow_redirects=True)
+    if response.status_code != 200:
+        return False
+    content_length = response.headers.get("Content-Length")
+    return content_length is not None and int(content_length) == size
+
+
+def fetch(url, dest):
+    """
+    Download url to dest via dest.part, resuming a previous partial download with an
+    HTTP Range request, then rename atomically. Returns the manifest entry for dest,
+    or None if the file is not published (404).
+    Raises on any other failure, leaving dest.part in place to resume next time.
+    """
+    part = dest.with_name(dest.name + ".part")
+    h = Digest()
+    offset = part.stat().st_size if part.is_file() else 0
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes=%d-" % offset
+
+    with get_session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 404:
+            return None
+        if response.status_code == 416:
+            # stale partial file, start over
+            part.unlink()
+            return fetch(url, dest)
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            # server honored Range, hash what we already have and append
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNKSIZE), b""):
+                    h.update(chunk)
+            mode = "ab"
+        else:
+            # server ignored Range (or no partial file), rewrite from the start
+            offset = 0
+            mode = "wb"
+
+        with open(part, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNKSIZE):
+                f.write(chunk)
+                h.update(chunk)
+
+        size = part.stat().st_size
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and offset + int(content_length) != size:
+            raise IOError("%s: expected %d bytes, got %d" % (url, offset + int(content_length), size))
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+
+    os.replace(part, dest)
+    return {
+        "url": url,
+        "size": size,
+        "etag": etag,
+        "last_modified": last_modified,
+        "sha256": h.hexdigest(),
+        "rows": h.rows(),
+        "downloaded": strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def download_files(downloaddir, start_date, end_date, prefix=PREFIX, suffix=SUFFIX, workers=WORKERS):
+    """
+    Download every weekly file from start_date to end_date into downloaddir
+    using a pool of workers threads. Complete files are skipped, truncated ones are
+    fetched again. Returns (number of files downloaded, manifest).
+    """
+    Path(downloaddir).mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(downloaddir)
+
+    def worker(url, filename):
+        dest = Path(downloaddir) / filename
+        entry = manifest.get(filename)
+        if is_complete(url, dest, entry):
+            if not entry or "rows" not in entry:
+                # adopt a file downloaded before the manifest (or its row counts) existed
+                sha256, rows = file_digest(dest)
+                entry = dict(entry or {"url": url, "etag": None, "last_modified": None, "downloaded": None},
+                             size=dest.stat().st_size, sha256=sha256, rows=rows)
+                with _manifest_lock:
+                    manifest[filename] = entry
+                    save_manifest(downloaddir, manifest)
+            return False
+        log("Downloading %s" % url)
+        entry = fetch(url, dest)
+        if entry is None:
+            log("Not found %s" % url)
+            return False
+        with _manifest_lock:
+            manifest[filename] = entry
+            save_manifest(downloaddir, manifest)
+        return True
+
+    count = 0
+    errors = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(worker, url, filename): url
+                   for url, filename in file_list(start_date, end_date, prefix, suffix)}
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    count += 1
+            except Exception as exc:
+                errors += 1
+                log("Failed %s: %s" % (futures[future], exc))
+
+    log("%d files downloaded, %d failed" % (count, errors))
+    return count, manifest
@@ -0,0 +1,199 @@
+# incremental ingest of downloaded files into mta_raw
+# used by 1-ingest_data.py and dbt_mta/models/ingest_data.py
+#
+# ingest_ledger records each file loaded into mta_raw, keyed by file name, size and sha256.
+# Only new or changed files are read, a changed file's old rows are replaced in one transaction.
+# Files are read from the Parquet lake (see mta_lake.py), converting any CSV not yet in it.
+
+from time import strftime
+
+from mta_download import file_info
+from mta_lake import LAKEDIR, convert_to_lake, read_lake
+
+
+def log(s):
+    print("%s - %s - %s" % (strftime("%H:%M:%S"), "mta_ingest", s))
+
+
+def table_name(table, schema=None):
+    return "%s.%s" % (schema, table) if schema else table
+
+
+RAW_TABLE = """
+create or replace table {table}(
+    "C/A" VARCHAR,
+    UNIT VARCHAR,
+    SCP VARCHAR,
+    STATION VARCHAR,
+    LINENAME VARCHAR,
+    DIVISION VARCHAR,
+    DATE DATE,
+    TIME TIME,
+    "DESC" VARCHAR,
+    ENTRY_COUNTER INTEGER,
+    EXIT_COUNTER INTEGER,
+    FILENAME VARCHAR);
+"""
+
+LEDGER_TABLE = """
+create or replace table {table}(
+    FILENAME VARCHAR PRIMARY KEY,
+    SIZE BIGINT,
+    SHA256 VARCHAR,
+    CSV_ROWS BIGINT,
+    LOADED_ROWS BIGINT,
+    MIN_DATE DATE,
+    MAX_DATE DATE,
+    INGESTED_AT TIMESTAMP);
+"""
+
+# one statement for all files so DuckDB can parallelize across them,
+# the lake's FILENAME column traces each row to its source file
+INSERT_FILES = """
+insert into %(table)s SELECT * FROM %(source)s
+"""
+
+# rows loaded and date range of each file, the date range lets dbt find the days new files touch
+UPDATE_LEDGER = """
+update %(ledger)s set LOADED_ROWS = counts.n, MIN_DATE = counts.min_date, MAX_DATE = counts.max_date
+from (select FILENAME, count(*) n, min(DATE) min_date, max(DATE) max_date
+      from %(raw)s
+      where list_contains(?, FILENAME)
+      group by FILENAME) counts
+where %(ledger)s.FILENAME = counts.FILENAME
+"""
+
+
+def table_columns(con, table, schema=None):
+    """column names of table, empty list if it doesn't exist"""
+    query = "select column_name from information_schema.columns where table_name = ? and table_schema = ?"
+    con.execute(query, [table, schema or "main"])
+    return [row[0].upper() for row in con.fetchall()]
+
+
+def create_tables(con, schema=None):
+    """(re)create empty mta_raw and ingest_ledger"""
+    con.execute(RAW_TABLE.format(table=table_name("mta_raw", schema)))
+    con.execute(LEDGER_TABLE.format(table=table_name("ingest_ledger", schema)))
+
+
+def ingest(con, datafiles, datadir, schema=None, full_refresh=False, threads=None, lakedir=LAKEDIR):
+    """
+    Load new or changed datafiles into mta_raw, drop rows of files no longer in datadir.
+    threads sets DuckDB parallelism for the load, default is DuckDB's (number of cores).
+    Returns the list of files loaded.
+    """
+    raw = table_name("mta_raw", schema)
+    ledger = table_name("ingest_ledger", schema)
+
+    if not full_refresh:
+        raw_columns = table_columns(con, "mta_raw", schema)
+        if not raw_columns or not table_columns(con, "ingest_ledger", schema):
+            log("%s or %s not found, can't ingest incrementally" % (raw, ledger))
+            full_refresh = True
+        elif "FILENAME" not in raw_columns:
+            log("%s has no FILENAME column, can't ingest incrementally" % raw)
+            full_refresh = True
+    if full_refresh:
+        log("Full refresh, creating %s and %s" % (raw, ledger))
+        create_tables(con, schema)
+    else:
+        # ledgers written before row counts and date ranges were tracked
+        con.execute("alter table %s add column if not exists CSV_ROWS BIGINT" % ledger)
+        con.execute("alter table %s add column if not exists LOADED_ROWS BIGINT" % ledger)
+        con.execute("alter table %s add column if not exists MIN_DATE DATE" % ledger)
+        con.execute("alter table %s add column if not exists MAX_DATE DATE" % ledger)
+
+    con.execute("select FILENAME, SIZE, SHA256 from %s" % ledger)
+    loaded = {row[0]: (row[1], row[2]) for row in con.fetchall()}
+    current = file_info(datafiles, datadir)
+
+    todo = sorted([filename for filename, (_, size, sha256, _) in current.items()
+                   if loaded.get(filename) != (size, sha256)])
+    removed = sorted([filename for filename in loaded if filename not in current])
+    log("%d files in ledger, %d new or changed, %d removed" % (len(loaded), len(todo), len(removed)))
+
+    # backfill row counts for files loaded before they were tracked
+    con.execute("select FILENAME from %s where CSV_ROWS is null" % ledger)
+    backfill = [row[0] for row in con.fetchall() if row[0] in current and row[0] not in todo]
+    if backfill:
+        con.executemany("update %s set CSV_ROWS = ? where FILENAME = ?" % ledger,
+                        [[current[filename][3], filename] for filename in backfill])
+    con.execute("select FILENAME from %s where MIN_DATE is null" % ledger)
+    backfill = [row[0] for row in con.fetchall() if row[0] not in todo]
+    if backfill:
+        con.execute(UPDATE_LEDGER % {'ledger': ledger, 'raw': raw}, [backfill])
+
+    for filename in removed:
+        log("Removing %s" % filename)
+        con.begin()
+        try:
+            con.execute("delete from %s where FILENAME = ?" % raw, [filename])
+            con.execute("delete from %s where FILENAME = ?" % ledger, [filename])
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+    if not todo:
+        return todo
+
+    # threads only for the load, the caller's connection gets its own setting back
+    previous_threads = con.execute("select current_setting('threads')").fetchone()[0]
+    if threads:
+        con.execute("SET threads = %d" % threads)
+    try:
+        convert_to_lake(con, current, lakedir)
+        log("Loading %d files from %s" % (len(todo), lakedir))
+        con.begin()
+        try:
+            changed = [filename for filename in todo if filename in loaded]
+            if changed:
+                con.execute("delete from %s where list_contains(?, FILENAME)" % raw, [changed])
+            con.execute(INSERT_FILES % {'table': raw, 'source': read_lake(lakedir, todo)})
+            con.executemany("insert or replace into %s (FILENAME, SIZE, SHA256, CSV_ROWS, INGESTED_AT) "
+                            "values (?, ?, ?, ?, current_timestamp)" % ledger,
+                            [[filename] + list(current[filename][1:]) for filename in todo])
+            con.execute(UPDATE_LEDGER % {'ledger': ledger, 'raw': raw}, [todo])
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    finally:
+        if threads:
+            con.execute("SET threads = %d" % previous_threads)
+
+    con.execute("select FILENAME, LOADED_ROWS from %s where list_contains(?, FILENAME) order by FILENAME"
+                % ledger, [todo])
+    for filename, rows in con.fetchall():
+        log("Loaded %8d rows from %s" % (rows or 0, filename))
+
+    return todo
+
+
+def verify(con, schema=None):
+    """
+    Compare each file's CSV row count in ingest_ledger with its rows in mta_raw.
+    Returns [(filename, csv_rows, rows in mta_raw)] for files that disagree, logs totals.
+    """
+    raw = table_name("mta_raw", schema)
+    ledger = table_name("ingest_ledger", schema)
+
+    query = """
+    with counts as (select FILENAME, count(*) n from %(raw)s group by FILENAME)
+    select
+        coalesce(ledger.FILENAME, counts.FILENAME) filename,
+        coalesce(ledger.CSV_ROWS, 0) csv_rows,
+        coalesce(counts.n, 0) loaded_rows
+    from %(ledger)s ledger
+    full outer join counts on ledger.FILENAME = counts.FILENAME
+    """ % {'ledger': ledger, 'raw': raw}
+    con.execute(query)
+    rows = con.fetchall()
+
+    log("Expected %d rows from %d files in %s" % (sum([r[1] for r in rows]), len(rows), ledger))
+    log("Loaded   %d rows into %s" % (sum([r[2] for r in rows]), raw))
+    mismatches = sorted([r for r in rows if r[1] != r[2]])
+    for filename, csv_rows, loaded_rows in mismatches:
+        log("MISMATCH %s: %d rows in file, %d rows in %s" % (filename, csv_rows, loaded_rows, raw))
+    return mismatches
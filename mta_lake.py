@@ -0,0 +1,123 @@
+# convert downloaded CSV files into a Parquet lake
+# used by 0-download_data.py, mta_ingest.py and dbt_mta/models/download_data.py
+#
+# each weekly file is parsed once into typed, zstd-compressed Parquet, sorted by DATE and STATION
+# so row group min/max statistics prune well, and Hive-partitioned by the rows' year and month:
+#   lake/year=2022/month=1/220108_0.parquet
+# a weekly file that spans a month boundary is written to both months.
+# New files are parsed together by one multi-file read_csv (up to BATCH files at a time) into a temp table,
+# then each file's rows are written out from there, so the lake keeps one set of Parquet files per download.
+# lake/manifest.json records the sha256 each file was converted from, a changed download is reconverted.
+
+from time import strftime
+from pathlib import Path
+
+from mta_download import load_manifest, save_manifest
+
+LAKEDIR = "lake"
+# files parsed by one read_csv, bounds the temp table on a cold backfill (about 200k rows per file)
+BATCH = 32
+
+READ_CSV = """
+read_csv(%(files)s, \
+         delim=',', \
+         header=True, \
+         filename=True, \
+         parallel=True, \
+         columns={'C/A': 'VARCHAR', \
+                  'UNIT': 'VARCHAR', \
+                  'SCP': 'VARCHAR', \
+                  'STATION': 'VARCHAR', \
+                  'LINENAME': 'VARCHAR', \
+                  'DIVISION': 'VARCHAR', \
+                  'DATE': 'DATE', \
+                  'TIME': 'TIME',\
+                  'DESC': 'VARCHAR',\
+                  'ENTRIES': 'INTEGER',\
+                  'EXITS': 'INTEGER',},\
+         dateformat='%%m/%%d/%%Y')
+"""
+
+# one scan over all the files, parallel across them, filename traces each row to its file
+STAGE_FILES = """
+CREATE OR REPLACE TEMP TABLE lake_new AS
+SELECT * REPLACE (regexp_replace(filename, '^.*/', '') AS filename),
+    year(DATE) "year",
+    month(DATE) "month"
+FROM %(read_csv)s
+ORDER BY filename
+"""
+
+COPY_FILE = """
+COPY (
+    SELECT * FROM lake_new
+    WHERE filename = '%(filename)s'
+    ORDER BY DATE, STATION
+) TO '%(lakedir)s' (FORMAT PARQUET,
+                    COMPRESSION ZSTD,
+                    PARTITION_BY ("year", "month"),
+                    FILENAME_PATTERN '%(stem)s_{i}',
+                    OVERWRITE_OR_IGNORE true)
+"""
+
+
+def log(s):
+    print("%s - %s - %s" % (strftime("%H:%M:%S"), "mta_lake", s))
+
+
+def sql_list(values):
+    """python list of strings -> SQL list literal"""
+    return "[%s]" % ", ".join(["'%s'" % v.replace("'", "''") for v in values])
+
+
+def lake_parts(lakedir, filename):
+    """Parquet files in the lake converted from filename"""
+    return sorted(Path(lakedir).glob("year=*/month=*/%s_*.parquet" % Path(filename).stem))
+
+
+def read_lake(lakedir, filenames):
+    """SQL table expression reading the lake files converted from filenames"""
+    globs = ["%s/year=*/month=*/%s_*.parquet" % (lakedir, Path(f).stem) for f in filenames]
+    return "read_parquet(%s, hive_partitioning=false)" % sql_list(globs)
+
+
+def convert_to_lake(con, files, lakedir=LAKEDIR):
+    """
+    Convert CSV files to Parquet in lakedir, skipping files already converted from the same sha256.
+    files is {filename: (path, size, sha256, rows)} as returned by mta_download.file_info.
+    Returns the list of files converted.
+    """
+    Path(lakedir).mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(lakedir)
+
+    todo = sorted([filename for filename, (_, _, sha256, _) in files.items()
+                   if manifest.get(filename, {}).get("sha256") != sha256 or not lake_parts(lakedir, filename)])
+    log("%d files in %s, %d to convert" % (len(manifest), lakedir, len(todo)))
+
+    for i in range(0, len(todo), BATCH):
+        batch = todo[i:i + BATCH]
+        con.execute(STAGE_FILES % {'read_csv': READ_CSV % {'files': sql_list([files[f][0] for f in batch])}})
+        for filename in batch:
+            _, size, sha256, rows = files[filename]
+            for part in lake_parts(lakedir, filename):
+                part.unlink()
+            con.execute(COPY_FILE % {'filename': filename.replace("'", "''"),
+                                     'lakedir': lakedir,
+                                     'stem': Path(filename).stem})
+            written = con.fetchall()[0][0]
+            if written != rows:
+                log("MISMATCH %s: %d rows in file, %d rows written to %s" % (filename, rows, written, lakedir))
+            manifest[filename] = {"sha256": sha256, "rows": written, "converted": strftime("%Y-%m-%d %H:%M:%S")}
+            save_manifest(lakedir, manifest)
+        con.execute("DROP TABLE lake_new")
+
+    removed = sorted([filename for filename in manifest if filename not in files])
+    for filename in removed:
+        log("Removing %s" % filename)
+        for part in lake_parts(lakedir, filename):
+            part.unlink()
+        del manifest[filename]
+    if removed:
+        save_manifest(lakedir, manifest)
+
+    return todo
@@ -0,0 +1,120 @@
+# outlier rules for mta_clean, used by 2-transform_data.py
+#
+# mta_clean is mta_diff less outliers, built in one pass. A row is dropped if
+# - entries or exits are negative, the turnstile counter got reset during maintenance
+# - entries or exits are greater than the hard limit of HARD_CUTOFF
+# - entries or exits are greater than the turnstile's cutoff, max(MIN_CUTOFF, mean + CUTOFF_SDS * SD) of its
+#   nonzero diffs within the limits above, or MIN_CUTOFF if it has MIN_OBSERVATIONS of them or fewer
+# - entries and exits are both 0
+# a rule on a null entries or exits doesn't drop the row
+#
+# turnstile_moments holds the running count, mean and M2 (sum of squared deviations from the mean) of each
+# turnstile's valid nonzero entries and exits. The new mta_diff rows' moments are merged into it (Chan et al.'s
+# parallel form of Welford's algorithm), so the stats match a recompute over all of mta_diff without one.
+
+HARD_CUTOFF = 7200
+MIN_CUTOFF = 2000
+CUTOFF_SDS = 3
+MIN_OBSERVATIONS = 20
+# the rules' parameters for the queries, valid is a diff within the hard limits
+RULES = {'hard': HARD_CUTOFF, 'min': MIN_CUTOFF, 'sds': CUTOFF_SDS, 'min_n': MIN_OBSERVATIONS}
+RULES['valid'] = "(ENTRIES < 0 or EXITS < 0 or ENTRIES > %(hard)d or EXITS > %(hard)d) is not true" % RULES
+
+# mta_diff only appends a turnstile's rows later than any of its rows it holds,
+# so each turnstile and direction's latest DATE_TIME folded in marks what is new
+MOMENTS_QUERY = """
+insert or replace into turnstile_moments
+with diff as (
+    select TURNSTILE_ID, STATION_ID, DATE_TIME, ENTRIES, EXITS
+    from mta_diff
+    where %(valid)s
+),
+batch as (
+    select readings.TURNSTILE_ID, readings.STATION_ID, readings.DIRECTION,
+        count(*) N, avg(X) MEAN, var_pop(X) * count(*) M2, max(readings.DATE_TIME) DATE_TIME
+    from (
+        select TURNSTILE_ID, STATION_ID, 'entries' DIRECTION, ENTRIES X, DATE_TIME from diff where ENTRIES > 0
+        union all
+        select TURNSTILE_ID, STATION_ID, 'exits' DIRECTION, EXITS X, DATE_TIME from diff where EXITS > 0
+    ) readings
+    left join turnstile_moments folded
+        on folded.TURNSTILE_ID = readings.TURNSTILE_ID and folded.DIRECTION = readings.DIRECTION
+    where folded.DATE_TIME is null or readings.DATE_TIME > folded.DATE_TIME
+    group by readings.TURNSTILE_ID, readings.STATION_ID, readings.DIRECTION
+)
+select
+    batch.TURNSTILE_ID,
+    batch.STATION_ID,
+    batch.DIRECTION,
+    coalesce(prev.N, 0) + batch.N,
+    coalesce(prev.MEAN, 0) + (batch.MEAN - coalesce(prev.MEAN, 0)) * batch.N / (coalesce(prev.N, 0) + batch.N),
+    coalesce(prev.M2, 0) + batch.M2
+        + (batch.MEAN - coalesce(prev.MEAN, 0)) ^ 2 * coalesce(prev.N, 0) * batch.N / (coalesce(prev.N, 0) + batch.N),
+    batch.DATE_TIME
+from batch
+left join turnstile_moments prev on prev.TURNSTILE_ID = batch.TURNSTILE_ID and prev.DIRECTION = batch.DIRECTION
+""" % RULES
+
+# turnstile_avg has both directions' stats and cutoffs, entry_avg and exit_avg one direction each
+CUTOFFS_QUERY = """
+create or replace temp macro turnstile_cutoff(mean, sd, n) as
+    case when n <= %(min_n)d or isnan(mean + %(sds)d * sd) then %(min)d
+    else greatest(mean + %(sds)d * sd, %(min)d) end;
+create or replace table turnstile_avg as
+select
+    *,
+    turnstile_cutoff(ENTRIES_MEAN, ENTRIES_SD, ENTRIES_N) ENTRIES_CUTOFF,
+    turnstile_cutoff(EXITS_MEAN, EXITS_SD, EXITS_N) EXITS_CUTOFF
+from (
+    select
+        STATION_ID,
+        TURNSTILE_ID,
+        max(MEAN) filter (where DIRECTION = 'entries') ENTRIES_MEAN,
+        max(SD) filter (where DIRECTION = 'entries') ENTRIES_SD,
+        coalesce(max(N) filter (where DIRECTION = 'entries'), 0) ENTRIES_N,
+        max(MEAN) filter (where DIRECTION = 'exits') EXITS_MEAN,
+        max(SD) filter (where DIRECTION = 'exits') EXITS_SD,
+        coalesce(max(N) filter (where DIRECTION = 'exits'), 0) EXITS_N
+    from (select *, case when N > 1 then sqrt(M2 / (N - 1)) end SD from turnstile_moments)
+    group by STATION_ID, TURNSTILE_ID
+);
+create or replace table entry_avg as
+select STATION_ID, TURNSTILE_ID, ENTRIES_MEAN MEAN, ENTRIES_SD SD, ENTRIES_N N, ENTRIES_CUTOFF
+from turnstile_avg
+where ENTRIES_N > 0;
+create or replace table exit_avg as
+select STATION_ID, TURNSTILE_ID, EXITS_MEAN MEAN, EXITS_SD SD, EXITS_N N, EXITS_CUTOFF
+from turnstile_avg
+where EXITS_N > 0;
+""" % RULES
+
+CLEAN_QUERY = """
+create or replace table mta_clean as
+select mta_diff.DATE, mta_diff.DATE_TIME, station_dim.STATION, turnstile_dim.TURNSTILE, ENTRIES, EXITS
+from mta_diff
+left join turnstile_avg on turnstile_avg.TURNSTILE_ID = mta_diff.TURNSTILE_ID
+join turnstile_dim on turnstile_dim.TURNSTILE_ID = mta_diff.TURNSTILE_ID
+join station_dim on station_dim.STATION_ID = mta_diff.STATION_ID
+where %(valid)s
+    and (ENTRIES > coalesce(ENTRIES_CUTOFF, %(min)d) or EXITS > coalesce(EXITS_CUTOFF, %(min)d)) is not true
+    and (ENTRIES = 0 and EXITS = 0) is not true
+-- sorted so row group zone maps prune date and station filters, see mta_pruning.py
+order by mta_diff.DATE, station_dim.STATION
+""" % RULES
+
+
+def update_moments(con):
+    """merge the mta_diff rows newer than turnstile_moments into it, returns the number of moments updated"""
+    con.execute(MOMENTS_QUERY)
+    return con.fetchall()[0][0]
+
+
+def compute_cutoffs(con):
+    """(re)create turnstile_avg, entry_avg and exit_avg from turnstile_moments"""
+    con.execute(CUTOFFS_QUERY)
+
+
+def create_clean(con):
+    """(re)create mta_clean from mta_diff less outliers, returns its row count"""
+    con.execute(CLEAN_QUERY)
+    return con.fetchall()[0][0]
@@ -0,0 +1,107 @@
+# zone map pruning report for mta_clean and the dashboard's rollup tables
+#
+# DuckDB keeps the min and max of every column for each row group (up to 122880 rows) and skips the row
+# groups a filter rules out. mta_clean and the rollups are written sorted by (date, station), so a date
+# range only reads the row groups holding those dates. For each standard dashboard query this reports
+# the row groups whose date zone map overlaps the query's dates (scanned) or not (skipped), and the rows
+# DuckDB's profiler says the table scan read.
+#
+#   python mta_pruning.py mta.db
+
+from time import strftime
+from datetime import timedelta
+import argparse
+import json
+import os
+import tempfile
+
+from mta_resources import connect
+
+# name, table, days back from the table's last date, extra filter ($station and $boro are one of the table's)
+QUERIES = [
+    ("last 4 weeks", "rollup_daily", 28, ""),
+    ("last 4 weeks, one station", "rollup_daily", 28, "and station = $station"),
+    ("last 4 weeks, one borough", "rollup_daily", 28, "and boro = $boro"),
+    ("last year", "rollup_daily", 365, ""),
+    ("last 4 weeks, 8am", "rollup_hourly", 28, "and hour = 8"),
+    ("last year, one station", "rollup_hourly", 365, "and station = $station"),
+    ("all dates, one station", "rollup_daily", None, "and station = $station"),
+    ("last 4 weeks", "mta_clean", 28, ""),
+    ("last 4 weeks, one station", "mta_clean", 28, "and station = $station"),
+]
+
+
+def log(s):
+    print("%s - %s - %s" % (strftime("%H:%M:%S"), "mta_pruning", s))
+
+
+def row_groups(con, table, startdate):
+    """row groups of table, and those whose date zone map reaches startdate (all, if it's None)"""
+    query = """
+    select count(*), count(*) filter (where $1::date is null or max_date is null or max_date >= $1::date)
+    from (
+        select row_group_id,
+            min(nullif(regexp_extract(stats, 'Min: ([0-9-]+)', 1), '')::date) min_date,
+            max(nullif(regexp_extract(stats, 'Max: ([0-9-]+)', 1), '')::date) max_date
+        from pragma_storage_info('%s')
+        where lower(column_name) = 'date'
+        group by row_group_id
+    )
+    """ % table
+    return con.execute(query, [startdate]).fetchone()
+
+
+def rows_scanned(con, query, params):
+    """rows the table scans of query read, from DuckDB's profiler"""
+    def scanned(node):
+        rows = node.get("operator_rows_scanned", 0) if node.get("operator_type") == "TABLE_SCAN" else 0
+        return rows + sum(scanned(child) for child in node.get("children", []))
+
+    fd, profile = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        con.execute("pragma enable_profiling = 'json'")
+        con.execute("set profiling_output = '%s'" % profile)
+        con.execute("""set custom_profiling_settings = '{"OPERATOR_ROWS_SCANNED": "true"}'""")
+        con.execute(query, params).fetchall()
+        con.execute("pragma disable_profiling")
+        with open(profile) as f:
+            return scanned(json.load(f))
+    finally:
+        os.remove(profile)
+
+
+def report(con, queries=QUERIES):
+    """
+    Run queries, log row groups scanned and skipped and rows read for each.
+    Returns a list of (name, table, row groups, scanned, rows read, rows).
+    """
+    tables = {row[0].lower() for row in con.execute("select table_name from information_schema.tables").fetchall()}
+    results = []
+    for name, table, days, where in queries:
+        if table not in tables:
+            continue
+        lastdate, rows, station, boro = con.execute(
+            "select max(date), count(*), any_value(station), %s from %s"
+            % ("any_value(boro)" if "$boro" in where else "null", table)).fetchone()
+        startdate = lastdate - timedelta(days=days) if days and lastdate else None
+        if startdate:
+            where = "and date >= $startdate " + where
+        query = "select sum(entries), sum(exits) from %s where true %s" % (table, where)
+        params = {k: v for k, v in [("startdate", startdate), ("station", station), ("boro", boro)] if "$" + k in query}
+        groups, scanned = row_groups(con, table, startdate)
+        read = rows_scanned(con, query, params)
+        log("%-14s %-26s %4d of %4d row groups scanned, %4d skipped, read %10d of %10d rows"
+            % (table, name, scanned, groups, groups - scanned, read, rows))
+        results.append((name, table, groups, scanned, read, rows))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Row groups the standard dashboard queries scan and skip")
+    parser.add_argument("dbfile", help="the database, e.g. mta.db")
+    args = parser.parse_args()
+
+    # the dashboard's settings, these are its queries
+    con = connect(args.dbfile, "dashboard", read_only=True)
+    report(con)
@@ -0,0 +1,101 @@
+# versioned builds and atomic publish of the DuckDB database
+# used by build.sh
+#
+# the live database is a symlink, e.g. mta.db -> mta-20230107-140000.db. A build copies the current
+# version to a new file, builds and tests it there, then publishes it by pointing the symlink at it
+# with a rename, which is atomic. Readers (the dashboard) never see a partly built database,
+# they switch to the new file between requests. The last KEEP versions are kept.
+#
+#   python mta_publish.py name mta.db                               prints e.g. mta-20230114-140000.db
+#   python mta_publish.py prepare mta.db mta-20230114-140000.db   copy the live version for a build
+#   python mta_publish.py publish mta.db mta-20230114-140000.db   point mta.db at it, remove old versions
+
+from time import strftime
+from pathlib import Path
+import argparse
+import os
+import subprocess
+
+from mta_resources import connect
+
+KEEP = 3
+
+
+def log(s):
+    print("%s - %s - %s" % (strftime("%H:%M:%S"), "mta_publish", s))
+
+
+def versions(link):
+    """versioned files of link, oldest first"""
+    link = Path(link)
+    return sorted(link.parent.glob("%s-*%s" % (link.stem, link.suffix)))
+
+
+def version_name(link):
+    """new versioned file name for link, e.g. mta-20230114-140000.db"""
+    link = Path(link)
+    return "%s-%s%s" % (link.stem, strftime("%Y%m%d-%H%M%S"), link.suffix)
+
+
+def prepare(link, target):
+    """
+    Copy the version link points to (or link itself, if it's still a plain file) to target, a new version
+    for the build to update, so incremental models carry on from the live data.
+    """
+    link = Path(link)
+    target = link.parent / Path(target).name
+    if link.exists():
+        log("Copying %s to %s" % (link.resolve(), target))
+        # reflink where the filesystem supports it, so the copy is near free until the build writes
+        subprocess.run(["cp", "--reflink=auto", str(link.resolve()), str(target)], check=True)
+    else:
+        log("%s not found, %s starts empty" % (link, target))
+    return target
+
+
+def publish(link, target, keep=KEEP):
+    """Atomically point link at target, then remove all but the newest keep versions"""
+    link = Path(link)
+    target = link.parent / Path(target).name
+
+    # refuse to publish a file that doesn't open or has no build stamp
+    con = connect(str(target), read_only=True)
+    generation = con.execute("select generation from build_generation").fetchall()[0][0]
+    con.close()
+
+    tmp = link.with_name(link.name + ".tmp")
+    if tmp.is_symlink() or tmp.exists():
+        tmp.unlink()
+    # relative link, so the directory can be mounted elsewhere (e.g. in docker)
+    os.symlink(target.name, tmp)
+    # replaces the old link, or on the first publish the plain file prepare copied from
+    os.replace(tmp, link)
+    log("Published %s as %s, build generation %s" % (target, link, generation))
+
+    # readers still on an old version keep it open, on POSIX removing it is safe
+    live = link.resolve()
+    old = [v for v in versions(link) if v.resolve() != live]
+    for version in old[:max(len(old) - (keep - 1), 0)]:
+        log("Removing %s" % version)
+        version.unlink()
+        wal = version.with_name(version.name + ".wal")
+        if wal.exists():
+            wal.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Versioned builds and atomic publish of the DuckDB database")
+    parser.add_argument("command", choices=["name", "prepare", "publish"],
+                        help="name: print a new version's name, prepare: copy the live database to target, "
+                             "publish: point link at target")
+    parser.add_argument("link", help="the live database, e.g. mta.db")
+    parser.add_argument("target", nargs="?", help="versioned file, e.g. mta-20230114-140000.db")
+    parser.add_argument("--keep", type=int, default=KEEP, help="versions to keep, including the new one")
+    args = parser.parse_args()
+
+    if args.command == "name":
+        print(version_name(args.link))
+    elif args.command == "prepare":
+        prepare(args.link, args.target)
+    else:
+        publish(args.link, args.target, args.keep)
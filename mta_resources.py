@@ -0,0 +1,173 @@
+# DuckDB resource settings per workload, and peak RSS and spill metrics per stage
+#
+# Every DuckDB connection takes memory_limit, threads, temp_directory and preserve_insertion_order from
+# DUCKDB_<WORKLOAD>_<SETTING> for its workload, else DUCKDB_<SETTING>, else DuckDB's default.
+# Workloads are ingest (1-ingest_data.py), transform (2-transform_data.py), dbt (the on-run-start hook in
+# dbt_project.yml) and dashboard (dashboard/app.py). The variables can be kept in duckdb.env (or the file
+# DUCKDB_CONFIG names), variables already in the environment take precedence over it.
+#
+# The build scripts log each stage's time, peak RSS and peak spill, the most DuckDB wrote to temp_directory
+# when the data didn't fit in memory_limit.
+#
+#   eval "$(python mta_resources.py env)"                 export duckdb.env's settings for dbt
+#   python mta_resources.py run dbt mta.db -- dbt run     run a command, log its peak RSS and spill
+
+from time import strftime, perf_counter
+from pathlib import Path
+import argparse
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import threading
+
+from dotenv import dotenv_values
+import duckdb
+
+SETTINGS = ["memory_limit", "threads", "temp_directory", "preserve_insertion_order"]
+WORKLOADS = ["ingest", "transform", "dbt", "dashboard"]
+CONFIG = os.getenv("DUCKDB_CONFIG", str(Path(__file__).parent / "duckdb.env"))
+# how often a stage checks the size of temp_directory
+SAMPLE_SECONDS = 0.5
+
+
+def log(s):
+    print("%s - %s - %s" % (strftime("%H:%M:%S"), "mta_resources", s))
+
+
+def is_setting(name):
+    """True for DUCKDB_<SETTING> and DUCKDB_<WORKLOAD>_<SETTING> variable names"""
+    return name.startswith("DUCKDB_") and name.endswith(tuple("_" + setting.upper() for setting in SETTINGS))
+
+
+def config(path=CONFIG):
+    """DUCKDB_ setting variables from the environment, and from path for those not set there"""
+    values = {k: v for k, v in dotenv_values(path).items() if is_setting(k) and v}
+    values.update({k: v for k, v in os.environ.items() if is_setting(k) and v})
+    return values
+
+
+def settings(workload=None, path=CONFIG):
+    """DuckDB settings for workload, only those configured, DuckDB's defaults apply to the rest"""
+    values = config(path)
+    result = {}
+    for name in SETTINGS:
+        value = values.get("DUCKDB_%s_%s" % (str(workload).upper(), name.upper()), values.get("DUCKDB_" + name.upper()))
+        if value:
+            result[name] = value
+    return result
+
+
+def connect(database, workload=None, **kwargs):
+    """duckdb.connect with workload's settings"""
+    values = settings(workload)
+    if values:
+        log("DuckDB settings%s: %s" % (" for " + workload if workload else "",
+                                       ", ".join("%s=%s" % kv for kv in values.items())))
+    return duckdb.connect(database, config=values, **kwargs)
+
+
+def size(n):
+    return "%.1f MB" % (n / 1e6)
+
+
+def dir_size(path):
+    """bytes in the files in path, 0 if it doesn't exist"""
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except OSError:
+        return 0
+
+
+def reset_peak_rss():
+    """reset this process's peak RSS (Linux), False where it can't be"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """peak RSS in bytes, since reset_peak_rss where it worked, else since the process started"""
+    if who == resource.RUSAGE_SELF:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    # ru_maxrss is in bytes on macOS, KB elsewhere
+    return resource.getrusage(who).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+class Stages:
+    """
+    Log time, peak RSS and peak spill for stages that run one after another: start(name) ends the
+    previous stage, logging its metrics, and starts the next, finish() ends the last. Call start before
+    logging the next stage's header so each stage's metrics follow its own log lines. temp_directory is DuckDB's spill directory,
+    children measures the peak RSS of subprocesses instead of this process.
+    """
+
+    def __init__(self, temp_directory, log=log, children=False):
+        self.temp_directory = temp_directory
+        self.log = log
+        self.children = children
+        self.name = None
+
+    @classmethod
+    def for_connection(cls, con, database, log=log):
+        """Stages spilling to con's temp_directory (default database.tmp)"""
+        temp_directory = con.execute("select current_setting('temp_directory')").fetchone()[0]
+        return cls(temp_directory or "%s.tmp" % database, log)
+
+    def sample(self):
+        while not self.stopped.wait(SAMPLE_SECONDS):
+            self.spill = max(self.spill, dir_size(self.temp_directory))
+
+    def start(self, name):
+        self.finish()
+        self.name = name
+        self.started = perf_counter()
+        self.spill = dir_size(self.temp_directory)
+        if not self.children:
+            reset_peak_rss()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def finish(self):
+        if self.name is None:
+            return
+        self.stopped.set()
+        self.sampler.join()
+        self.spill = max(self.spill, dir_size(self.temp_directory))
+        rss = peak_rss(resource.RUSAGE_CHILDREN if self.children else resource.RUSAGE_SELF)
+        self.log("Stage    %s: %.1fs, peak RSS %s, peak spill %s"
+                 % (self.name, perf_counter() - self.started, size(rss), size(self.spill)))
+        self.name = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DuckDB settings per workload, peak RSS and spill per stage")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("env", help="print the DUCKDB_ variables as shell exports")
+    run_parser = subparsers.add_parser("run", help="run a command, log its time, peak RSS and peak spill")
+    run_parser.add_argument("workload", choices=WORKLOADS)
+    run_parser.add_argument("database", help="the database the command works on, for its temp_directory")
+    run_parser.add_argument("cmd", nargs=argparse.REMAINDER, help="the command, after --")
+    args = parser.parse_args()
+
+    if args.command == "env":
+        for k, v in config().items():
+            print("export %s=%s" % (k, shlex.quote(v)))
+    else:
+        cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+        stages = Stages(settings(args.workload).get("temp_directory", "%s.tmp" % args.database), children=True)
+        stages.start(" ".join(cmd))
+        returncode = subprocess.run(cmd).returncode
+        stages.finish()
+        sys.exit(returncode)
@@ -0,0 +1,5 @@
+# the modules under test are top level scripts and helpers in the repo root
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,157 @@
+# mta_download against a local HTTP server standing in for web.mta.info
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import threading
+
+import pytest
+
+import mta_download
+
+# 2022-01-01 and 2022-01-08 are Saturdays, the files are 220101.txt and 220108.txt
+START, END = date(2022, 1, 1), date(2022, 1, 8)
+HEADER = b"C/A,UNIT,SCP,STATION,LINENAME,DIVISION,DATE,TIME,DESC,ENTRIES,EXITS\n"
+ROW = b"A002,R051,02-00-00,59 ST,NQR456W,BMT,01/01/2022,03:00:00,REGULAR,0007649127,0002606709\n"
+
+
+class Handler(BaseHTTPRequestHandler):
+    """serves Handler.files by name, honors Range, records (method, path, Range) of each request"""
+    files = {}
+    truncate = {}
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_file(self, body):
+        name = self.path.rsplit("_", 1)[-1]
+        Handler.requests.append((self.command, name, self.headers.get("Range")))
+        data = Handler.files.get(name)
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        status = 200
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", '"%s"' % hashlib.md5(data).hexdigest())
+        self.end_headers()
+        if body:
+            # drop the connection part way through a truncated file, once
+            cut = Handler.truncate.pop(name, None)
+            self.wfile.write(data[start:cut] if cut else data[start:])
+
+    def do_GET(self):
+        self.send_file(True)
+
+    def do_HEAD(self):
+        self.send_file(False)
+
+
+@pytest.fixture
+def server():
+    # 220101.txt spans a few of mta_download's read chunks
+    Handler.files = {"220101.txt": HEADER + ROW * 30000, "220108.txt": HEADER + ROW * 3}
+    Handler.truncate = {}
+    Handler.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d/turnstile_" % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def download(downloaddir, prefix):
+    return mta_download.download_files(downloaddir, START, END, prefix=prefix, workers=2)
+
+
+def gets(name):
+    return [r for r in Handler.requests if r[0] == "GET" and r[1] == name]
+
+
+def test_download_and_manifest(tmp_path, server):
+    count, manifest = download(tmp_path, server)
+    assert count == 2
+    for name, data in Handler.files.items():
+        assert (tmp_path / name).read_bytes() == data
+        assert not (tmp_path / (name + ".part")).exists()
+        entry = json.loads((tmp_path / "manifest.json").read_text())[name]
+        assert entry["size"] == len(data)
+        assert entry["etag"] == '"%s"' % hashlib.md5(data).hexdigest()
+        assert entry["sha256"] == hashlib.sha256(data).hexdigest()
+        assert entry["rows"] == data.count(b"\n") - 1
+        assert entry["url"] == server + name
+
+    # a second run finds both complete in the manifest and fetches nothing
+    Handler.requests = []
+    assert download(tmp_path, server)[0] == 0
+    assert Handler.requests == []
+
+
+def test_resume_part_file(tmp_path, server):
+    data = Handler.files["220101.txt"]
+    (tmp_path / "220101.txt.part").write_bytes(data[:1000])
+    download(tmp_path, server)
+    assert gets("220101.txt") == [("GET", "220101.txt", "bytes=1000-")]
+    assert (tmp_path / "220101.txt").read_bytes() == data
+    # the sha256 covers the bytes already on disk, not just the resumed tail
+    entry = mta_download.load_manifest(tmp_path)["220101.txt"]
+    assert entry["sha256"] == hashlib.sha256(data).hexdigest()
+    assert entry["rows"] == 30000
+
+
+def test_truncated_transfer_resumes(tmp_path, server):
+    data = Handler.files["220101.txt"]
+    Handler.truncate["220101.txt"] = len(data) - 1000
+    # the dropped connection fails the file and leaves the chunks read so far in the part file
+    assert download(tmp_path, server)[0] == 1
+    assert not (tmp_path / "220101.txt").exists()
+    part = (tmp_path / "220101.txt.part").read_bytes()
+    assert 0 < len(part) < len(data) and data.startswith(part)
+    assert "220101.txt" not in mta_download.load_manifest(tmp_path)
+
+    assert download(tmp_path, server)[0] == 1
+    assert gets("220101.txt")[-1] == ("GET", "220101.txt", "bytes=%d-" % len(part))
+    assert (tmp_path / "220101.txt").read_bytes() == data
+
+
+def test_stale_part_file_416(tmp_path, server):
+    data = Handler.files["220108.txt"]
+    # a part file as long as the whole file: the server answers 416, start over
+    (tmp_path / "220108.txt.part").write_bytes(b"x" * (len(data) + 10))
+    download(tmp_path, server)
+    assert gets("220108.txt") == [("GET", "220108.txt", "bytes=%d-" % (len(data) + 10)),
+                                  ("GET", "220108.txt", None)]
+    assert (tmp_path / "220108.txt").read_bytes() == data
+    assert not (tmp_path / "220108.txt.part").exists()
+
+
+def test_truncated_file_without_manifest(tmp_path, server):
+    data = Handler.files["220101.txt"]
+    # e.g. left behind by the old curl loop, checked against Content-Length and fetched again
+    (tmp_path / "220101.txt").write_bytes(data[:100])
+    # complete but not in the manifest: adopted without fetching
+    (tmp_path / "220108.txt").write_bytes(Handler.files["220108.txt"])
+    assert download(tmp_path, server)[0] == 1
+    assert (tmp_path / "220101.txt").read_bytes() == data
+    assert gets("220108.txt") == []
+    manifest = mta_download.load_manifest(tmp_path)
+    assert manifest["220108.txt"]["rows"] == 3
+    assert manifest["220108.txt"]["sha256"] == hashlib.sha256(Handler.files["220108.txt"]).hexdigest()
+
+
+def test_404_leaves_no_output(tmp_path, server):
+    del Handler.files["220108.txt"]
+    assert download(tmp_path, server)[0] == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["220101.txt", "manifest.json"]
+    assert "220108.txt" not in mta_download.load_manifest(tmp_path)
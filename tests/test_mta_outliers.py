@@ -0,0 +1,209 @@
+# mta_outliers' rules on a small synthetic mta_diff, which rows mta_clean keeps and which it drops
+from datetime import datetime, timedelta
+import statistics
+
+import duckdb
+import pytest
+
+import mta_outliers
+from mta_outliers import HARD_CUTOFF, MIN_CUTOFF, CUTOFF_SDS, MIN_OBSERVATIONS
+
+START = datetime(2022, 1, 1)
+
+# the tables the rules read, as 2-transform_data.py creates them
+TABLES = """
+create table station_dim(STATION_ID INTEGER PRIMARY KEY, STATION VARCHAR UNIQUE);
+create table turnstile_dim(TURNSTILE_ID INTEGER PRIMARY KEY, TURNSTILE VARCHAR, STATION_ID INTEGER);
+create table mta_diff(
+    DATE DATE,
+    DATE_TIME TIMESTAMP,
+    STATION_ID INTEGER,
+    TURNSTILE_ID INTEGER,
+    ENTRIES INTEGER,
+    EXITS INTEGER);
+create table turnstile_moments(
+    TURNSTILE_ID INTEGER,
+    STATION_ID INTEGER,
+    DIRECTION VARCHAR,
+    N BIGINT,
+    MEAN DOUBLE,
+    M2 DOUBLE,
+    DATE_TIME TIMESTAMP,
+    PRIMARY KEY (TURNSTILE_ID, DIRECTION));
+"""
+
+# turnstiles: a quiet one with too few readings for a cutoff of its own (MIN_CUTOFF), a busy one whose entries
+# cutoff is above MIN_CUTOFF, one whose exits are busy and entries quiet, and two whose entries would have a cutoff
+# above MIN_CUTOFF, with exactly MIN_OBSERVATIONS readings (so it doesn't) and one more (so it does)
+QUIET, BUSY, BUSY_EXITS, FEW, ENOUGH = 1, 2, 3, 4, 5
+
+
+def spread(n, low, high):
+    """n values alternating between low and high"""
+    return [low if i % 2 else high for i in range(n)]
+
+
+def readings():
+    """{turnstile: [(label, entries, exits)]}, the labeled rows are the ones the tests check"""
+    return {
+        QUIET: [(None, 100 + i, 50 + i) for i in range(10)] + [
+            ("negative entries", -5, 10),
+            ("negative exits", 10, -1),
+            ("entries over hard limit", HARD_CUTOFF + 1, 10),
+            ("exits over hard limit", 10, HARD_CUTOFF + 1),
+            ("at hard limit, over cutoff", HARD_CUTOFF, 10),
+            ("entries over cutoff", MIN_CUTOFF + 100, 10),
+            ("exits over cutoff", 10, MIN_CUTOFF + 100),
+            ("at cutoff", MIN_CUTOFF, MIN_CUTOFF),
+            ("entries and exits 0", 0, 0),
+            ("entries 0", 0, 5),
+            ("exits 0", 5, 0),
+            ("null entries", None, 10),
+            ("null exits", 10, None),
+            ("null entries and exits", None, None),
+            ("null entries, exits 0", None, 0),
+            ("null entries, exits over hard limit", None, HARD_CUTOFF + 1),
+            ("null entries, exits over cutoff", None, MIN_CUTOFF + 100),
+        ],
+        BUSY: [(None, e, 100) for e in spread(30, 1800, 2200)] + [
+            ("busy entries under turnstile cutoff", 2500, 100),
+            ("busy entries over turnstile cutoff", 4000, 100),
+            ("busy entries, exits over cutoff", 2000, MIN_CUTOFF + 100),
+        ],
+        BUSY_EXITS: [(None, 100, x) for x in spread(30, 1800, 2200)] + [
+            ("busy exits under turnstile cutoff", 100, 2500),
+            ("busy exits over turnstile cutoff", 100, 4000),
+            ("busy exits, entries over cutoff", MIN_CUTOFF + 100, 2000),
+        ],
+        FEW: [(None, e, 100) for e in spread(MIN_OBSERVATIONS - 1, 1200, 2000)] + [
+            ("MIN_OBSERVATIONS readings, over MIN_CUTOFF", MIN_CUTOFF + 100, 100),
+        ],
+        ENOUGH: [(None, e, 100) for e in spread(MIN_OBSERVATIONS, 1200, 2000)] + [
+            ("MIN_OBSERVATIONS + 1 readings, over MIN_CUTOFF", MIN_CUTOFF + 100, 100),
+        ],
+    }
+
+
+def valid(entries, exits):
+    """within the hard limits, a null doesn't make a row invalid"""
+    return not any(v is not None and (v < 0 or v > HARD_CUTOFF) for v in (entries, exits))
+
+
+KEPT = {
+    "at cutoff", "entries 0", "exits 0",
+    "null entries", "null exits", "null entries and exits", "null entries, exits 0",
+    "busy entries under turnstile cutoff", "busy exits under turnstile cutoff",
+    "MIN_OBSERVATIONS + 1 readings, over MIN_CUTOFF",
+}
+
+
+def cutoff(values):
+    """the turnstile cutoff of the valid nonzero values, computed here from the rule's definition"""
+    values = [v for v in values if v is not None and v > 0]
+    if len(values) <= MIN_OBSERVATIONS:
+        return MIN_CUTOFF
+    return max(statistics.mean(values) + CUTOFF_SDS * statistics.stdev(values), MIN_CUTOFF)
+
+
+@pytest.fixture
+def clean():
+    """run the rules, returns (con, {label: kept}, {turnstile: (entries rows, exits rows)})"""
+    con = duckdb.connect()
+    con.execute(TABLES)
+    con.execute("insert into station_dim values (1, 'STATION')")
+    rows = readings()
+    labels = {}
+    values = {}
+    diff = []
+    for turnstile, turnstile_rows in rows.items():
+        con.execute("insert into turnstile_dim values (?, ?, 1)", [turnstile, "T%d" % turnstile])
+        # the entries and exits of the valid rows, a turnstile's stats are of the nonzero ones
+        values[turnstile] = ([r[1] for r in turnstile_rows if valid(r[1], r[2])],
+                             [r[2] for r in turnstile_rows if valid(r[1], r[2])])
+        for i, (label, entries, exits) in enumerate(turnstile_rows):
+            date_time = START + timedelta(hours=4 * i)
+            diff.append([date_time.date(), date_time, 1, turnstile, entries, exits])
+            if label:
+                labels[label] = ("T%d" % turnstile, date_time)
+    con.executemany("insert into mta_diff values (?, ?, ?, ?, ?, ?)", diff)
+
+    mta_outliers.update_moments(con)
+    mta_outliers.compute_cutoffs(con)
+    rows_kept = mta_outliers.create_clean(con)
+    kept = set(con.execute("select TURNSTILE, DATE_TIME from mta_clean").fetchall())
+    assert rows_kept == len(kept)
+    return con, {label: key in kept for label, key in labels.items()}, values
+
+
+def test_cutoffs(clean):
+    con, _, values = clean
+    entries = con.execute("select TURNSTILE_ID, ENTRIES_CUTOFF from entry_avg").fetchall()
+    exits = con.execute("select TURNSTILE_ID, EXITS_CUTOFF from exit_avg").fetchall()
+    cutoffs = dict([((t, 'entries'), c) for t, c in entries] + [((t, 'exits'), c) for t, c in exits])
+    for turnstile, (entries, exits) in values.items():
+        assert cutoffs[(turnstile, 'entries')] == pytest.approx(cutoff(entries))
+        assert cutoffs[(turnstile, 'exits')] == pytest.approx(cutoff(exits))
+    # the busy directions get a cutoff of their own, between the test rows under and over it
+    assert 2500 < cutoffs[(BUSY, 'entries')] < 4000
+    assert 2500 < cutoffs[(BUSY_EXITS, 'exits')] < 4000
+    assert cutoffs[(BUSY, 'exits')] == cutoffs[(BUSY_EXITS, 'entries')] == MIN_CUTOFF
+    assert cutoffs[(QUIET, 'entries')] == cutoffs[(QUIET, 'exits')] == MIN_CUTOFF
+    # MIN_OBSERVATIONS readings or fewer get MIN_CUTOFF, one more gets its own
+    assert cutoffs[(FEW, 'entries')] == MIN_CUTOFF
+    assert cutoffs[(ENOUGH, 'entries')] > MIN_CUTOFF + 100
+
+
+def test_moments_match_recompute(clean):
+    con, _, values = clean
+    for turnstile, direction, n, mean, sd in con.execute(
+            "select TURNSTILE_ID, DIRECTION, N, MEAN, sqrt(M2 / (N - 1)) from turnstile_moments").fetchall():
+        nonzero = [v for v in values[turnstile][direction == 'exits'] if v is not None and v > 0]
+        assert n == len(nonzero)
+        assert mean == pytest.approx(statistics.mean(nonzero))
+        assert sd == pytest.approx(statistics.stdev(nonzero))
+
+
+@pytest.mark.parametrize("label", [label for rows in readings().values() for label, _, _ in rows if label])
+def test_rule(clean, label):
+    _, kept, _ = clean
+    assert kept[label] == (label in KEPT)
+
+
+def test_unlabeled_rows_kept(clean):
+    con, kept, _ = clean
+    unlabeled = sum(len([r for r in rows if r[0] is None]) for rows in readings().values())
+    assert con.execute("select count(*) from mta_clean").fetchone()[0] == unlabeled + len(KEPT)
+
+
+def test_moments_merge_incrementally(clean):
+    """a second batch of diffs merged into turnstile_moments matches the stats of all the rows"""
+    con, _, values = clean
+    later = START + timedelta(days=365)
+    new = [2600, 1400, 3000]
+    con.executemany("insert into mta_diff values (?, ?, 1, ?, ?, 100)",
+                    [[(later + timedelta(hours=4 * i)).date(), later + timedelta(hours=4 * i), BUSY, e]
+                     for i, e in enumerate(new)])
+    assert mta_outliers.update_moments(con) == 2
+    n, mean, sd = con.execute("select N, MEAN, sqrt(M2 / (N - 1)) from turnstile_moments "
+                              "where TURNSTILE_ID = ? and DIRECTION = 'entries'", [BUSY]).fetchone()
+    entries = [v for v in values[BUSY][0] if v is not None and v > 0] + new
+    assert n == len(entries)
+    assert mean == pytest.approx(statistics.mean(entries))
+    assert sd == pytest.approx(statistics.stdev(entries))
+
+
+def test_moments_merge_per_turnstile(clean):
+    """a turnstile's new diffs are folded in even if another turnstile has later ones"""
+    con, _, values = clean
+    latest = con.execute("select max(DATE_TIME) from turnstile_moments").fetchone()[0]
+    new = [1500, 1700]
+    rows = [[START + timedelta(hours=4 * (len(readings()[FEW]) + i)), e] for i, e in enumerate(new)]
+    assert all(date_time < latest for date_time, _ in rows)
+    con.executemany("insert into mta_diff values (?, ?, 1, ?, ?, 100)",
+                    [[date_time.date(), date_time, FEW, e] for date_time, e in rows])
+    assert mta_outliers.update_moments(con) == 2
+    for direction, expected in [('entries', values[FEW][0] + new), ('exits', values[FEW][1] + [100] * len(new))]:
+        n, mean = con.execute("select N, MEAN from turnstile_moments where TURNSTILE_ID = ? and DIRECTION = ?",
+                              [FEW, direction]).fetchone()
+        assert n == len(expected)
+        assert mean == pytest.approx(statistics.mean(expected))